@@ -1,9 +1,17 @@
+from collections import Counter
 from copy import deepcopy
 from difflib import SequenceMatcher
 from lxml import etree
 import re
+import sys
 from . import utils, actions, diff_match_patch
 
+# Compiled once, and without the smart strings node_text has no use for
+_TEXT_NODES = etree.XPath("text()", smart_strings=False)
+
+# Tokens are encoded from chr(1), so this many fit in the shared vocabulary
+_VOCABULARY_SIZE = sys.maxunicode
+
 
 class Differ:
     def __init__(self, F=None, uniqueattrs=None, fast_match=False):
@@ -34,9 +42,26 @@ class Differ:
         self._l2rmap = None
         self._r2lmap = None
         self._inorder = None
+        # The right tree isn't modified, so its nodes are walked only once
+        self._right_breadth_first = None
         # Well, except the text cache, it's used by the ratio tests,
         # so we set that to a dict so the tests work.
         self._text_cache = {}
+        self._token_cache = {}
+        self._token_count_cache = {}
+        # Token lists encoded as strings, one character per token. The
+        # vocabulary is shared by all the nodes.
+        self._chars_cache = {}
+        self._vocabulary = {}
+        self._weight_cache = {}
+        # The total weight of the children of a node
+        self._child_weight_cache = {}
+        # Paths of the left nodes, until the left tree is modified
+        self._xpath_cache = {}
+        # Leaf ratios only depend on the two nodes, so they can be reused
+        # by the post processing of match(). Nodes are used as keys to keep
+        # them alive, so that a pair can't be mistaken for another one.
+        self._ratio_cache = {}
 
     def set_trees(self, left, right):
         self.clear()
@@ -53,18 +78,22 @@ class Differ:
             )
 
         # Left gets modified as a part of the diff, deepcopy it first.
+        # lxml copies the subtree in C, tail included, which is faster than
+        # a tostring/fromstring round trip.
         self.left = deepcopy(left)
         self.right = right
 
     def append_match(self, lnode, rnode):
         self._l2rmap[id(lnode)] = rnode
         self._r2lmap[id(rnode)] = lnode
-        self._matches.append((lnode, rnode))
+        if self._matches is not None:
+            # diff() matches the nodes it inserts after match() returned,
+            # they are part of its result too.
+            self._matches.append((lnode, rnode))
 
     def remove_match(self, lnode, rnode):
         del self._l2rmap[id(lnode)]
         del self._r2lmap[id(rnode)]
-        self._matches.remove((lnode, rnode))
 
     def match(self, left=None, right=None):
         if left is not None or right is not None:
@@ -75,26 +104,50 @@ class Differ:
             return self._matches
 
         # Initialize the caches:
-        self._matches = []
         self._l2rmap = {}
         self._r2lmap = {}
         self._inorder = set()
         self._text_cache = {}
+        self._token_cache = {}
+        self._token_count_cache = {}
+        self._chars_cache = {}
+        self._vocabulary = {}
+        self._weight_cache = {}
+        self._child_weight_cache = {}
 
         lnodes = list(utils.post_order_traverse(self.left))
         rnodes = list(utils.post_order_traverse(self.right))
 
+        if (
+            not self.fast_match
+            and len(lnodes) == len(rnodes)
+            and etree.tostring(self.left) == etree.tostring(self.right)
+        ):
+            # Identical trees match node for node, there's nothing to score.
+            # The full matching would find the same pairs, in post order.
+            # The fast match finds them in another order, so it still runs.
+            for lnode, rnode in zip(lnodes, rnodes):
+                self.append_match(lnode, rnode)
+            self._matches = list(zip(lnodes, rnodes))
+            return self._matches
+
+        # Weights are used in the inner loops of child_ratio, compute them once
+        for node in lnodes + rnodes:
+            self.node_weight(node)
+
         # Make sure the roots are matched, we do that by
         # removing them from the lists of nodes, so it can't match, and add
-        # them back last.
-        lnodes.remove(self.left)
-        rnodes.remove(self.right)
+        # them back last. They are last in post order.
+        lnodes.pop()
+        rnodes.pop()
 
         if self.fast_match:
             # First find matches with longest_common_subsequence:
             matches = list(
                 utils.longest_common_subsequence(
-                    lnodes, rnodes, lambda x, y: self.node_ratio(x, y) >= self.F
+                    lnodes,
+                    rnodes,
+                    lambda x, y: self._node_ratio_if_reachable(x, y) >= self.F,
                 )
             )
 
@@ -107,35 +160,56 @@ class Differ:
                 lnode = lnodes.pop(left_match)
                 rnode = rnodes.pop(right_match)
 
+        # Index the remaining right nodes by token, so that most left nodes
+        # are only compared to the right nodes they can match.
+        rindex = self._index_nodes(rnodes)
+        # Matched right nodes are marked as dead rather than removed from
+        # the list, which would be O(N) for each match.
+        alive = bytearray(b"\x01" * len(rnodes))
+
         for lnode in lnodes:
             max_match = 0
             match_node = None
 
-            for rnode in rnodes:  # TODO create an iterator that first try to match close to latest match
-                match = self.node_ratio(lnode, rnode)
+            # A leaf identical to a right leaf is a total match, so there's
+            # no need to look further than the first one.
+            pos = self._identical_leaf(lnode, rnodes, rindex, alive)
+            if pos is not None:
+                candidates = (pos,)
+            else:
+                candidates = self._match_candidates(lnode, rindex)
+
+            for pos in candidates:
+                if not alive[pos]:
+                    continue
+                rnode = rnodes[pos]
+                match = self._node_ratio_if_reachable(lnode, rnode)
                 if match > max_match:
                     match_node = rnode
+                    match_pos = pos
                     max_match = match
-
-                if match == 1.0:
-                    # This is a total match, break here
-                    break
+                    if match == 1.0:
+                        # This is a total match, break here
+                        break
 
             if max_match >= self.F:
                 self.append_match(lnode, match_node)
 
                 # We don't want to check nodes that already are matched
                 if match_node is not None:
-                    rnodes.remove(match_node)
+                    alive[match_pos] = 0
+
+        # The index isn't needed by the post processing, release it now
+        del rindex, alive
 
         # post process match, iterate on tree top down and try to match children of matched nodes together.
-        for rnode in utils.breadth_first_traverse(self.right):
-            if id(rnode) in self._r2lmap and rnode.getchildren():
+        for rnode in self._right_nodes_breadth_first():
+            if id(rnode) in self._r2lmap and len(rnode):
                 lnode = self._r2lmap[id(rnode)]
-                lchilds = lnode.getchildren()
-                rchilds = rnode.getchildren()
-                # remove childs that are already matched to a child of the match, copy list to avoid iterator invalidation when removing
-                for rchild in list(rchilds):
+                lchilds = list(lnode)
+                rchilds = list(rnode)
+                # remove childs that are already matched to a child of the match, iterate the node itself to avoid iterator invalidation when removing
+                for rchild in rnode:
                     if (
                         id(rchild) in self._r2lmap
                         and self._r2lmap[id(rchild)] in lchilds
@@ -147,12 +221,12 @@ class Differ:
                     max_match = 0
                     match_node = None
                     for lchild in lchilds:
-                        match = self.node_ratio(lchild, rchild)
+                        match = self._node_ratio_if_reachable(lchild, rchild)
                         if match > max_match:
                             match_node = lchild
                             max_match = match
-                        if match == 1.0:
-                            break
+                            if match == 1.0:
+                                break
                     if max_match >= self.F:
                         # remove old matches
                         if id(rchild) in self._r2lmap:
@@ -165,9 +239,124 @@ class Differ:
 
         # Match the roots
         self.append_match(self.left, self.right)
+
+        # The ratios and tokens are only needed while matching, don't keep
+        # them around while diffing.
+        self._ratio_cache = {}
+        self._token_cache = {}
+        self._token_count_cache = {}
+        self._chars_cache = {}
+        self._vocabulary = {}
+
+        # The maps keep the order in which the matches were made, a removed
+        # match being forgotten, so the list of matches is built from them.
+        self._matches = [
+            (lnode, self._l2rmap[id(lnode)]) for lnode in self._r2lmap.values()
+        ]
         return self._matches
 
+    def _right_nodes_breadth_first(self):
+        if self._right_breadth_first is None:
+            self._right_breadth_first = list(utils.breadth_first_traverse(self.right))
+        return self._right_breadth_first
+
+    def _index_nodes(self, nodes):
+        """Index nodes by the tokens of their text
+
+        For each token, the index lists the positions of the nodes
+        containing it, with the number of occurrences. Nodes without text
+        are indexed by tag instead. Leaves are also indexed by their text,
+        latest position first."""
+        lengths = []
+        tokens = {}
+        empty = {}
+        leaves = {}
+        for pos, node in reversed(list(enumerate(nodes))):
+            if not len(node):
+                leaves.setdefault(self._leaf_key(node), []).append(pos)
+        for pos, node in enumerate(nodes):
+            tokenList = self.node_tokens(node)
+            if not tokenList:
+                lengths.append(0)
+                empty.setdefault(node.tag, []).append(pos)
+                continue
+            lengths.append(len(tokenList))
+            for token, count in self.node_token_counts(node).items():
+                tokens.setdefault(token, []).append((pos, count))
+        return (lengths, tokens, empty, leaves)
+
+    def _leaf_key(self, node):
+        text = self.node_text(node)
+        if text:
+            # Leaf ratios don't depend on the tag when there is some text
+            return (text, None)
+        return ("", node.tag)
+
+    def _identical_leaf(self, lnode, rnodes, index, alive):
+        """Return the position of the first unmatched node identical to lnode
+
+        Only leaves are looked up: the ratio of other nodes depends on how
+        their children were matched, and unique attributes can make any node
+        a total match. Returns None if there is no such node."""
+        if len(lnode) or self._has_unique_attrs(lnode):
+            return None
+        positions = index[3].get(self._leaf_key(lnode))
+        if not positions:
+            return None
+        # Positions are in reverse order, so matched nodes can be dropped
+        while positions and not alive[positions[-1]]:
+            positions.pop()
+        for pos in reversed(positions):
+            # Unique attributes can still make identical leaves differ
+            if alive[pos] and self._node_ratio_if_reachable(lnode, rnodes[pos]) == 1.0:
+                return pos
+        return None
+
+    def _match_candidates(self, lnode, index):
+        """Return the positions of the indexed nodes lnode may match, in order
+
+        A node without children nor unique attributes can't get a better
+        ratio than its leaf ratio, which in turn can't be better than the
+        share of tokens the two texts have in common. Any other node is
+        compared to all the indexed nodes."""
+        lengths, tokens, empty, leaves = index
+        if self.F <= 0 or len(lnode) or self._has_unique_attrs(lnode):
+            return range(len(lengths))
+
+        tokenList = self.node_tokens(lnode)
+        if not tokenList:
+            positions = empty.get(lnode.tag, [])
+        else:
+            shared = {}
+            for token, count in self.node_token_counts(lnode).items():
+                for pos, rcount in tokens.get(token, ()):
+                    shared[pos] = shared.get(pos, 0) + min(count, rcount)
+            positions = sorted(
+                pos
+                for pos, common in shared.items()
+                if common / max(len(tokenList), lengths[pos]) >= self.F
+            )
+        return positions
+
+    def _has_unique_attrs(self, node):
+        for attr in self.uniqueattrs:
+            if not isinstance(attr, str):
+                tag, attr = attr
+            if attr in node.attrib:
+                return True
+        return False
+
     def node_ratio(self, left, right):
+        return self._node_ratio(left, right, prune=False)
+
+    def _node_ratio_if_reachable(self, left, right):
+        """Return node_ratio(), or an upper bound of it when it's below F
+
+        match() only compares the ratios against F, so it doesn't need the
+        exact ratio of pairs that can't reach it."""
+        return self._node_ratio(left, right, prune=True)
+
+    def _node_ratio(self, left, right, prune):
         for attr in self.uniqueattrs:
             if not isinstance(attr, str):
                 # If it's actually a sequence of (tag, attr), the tags must
@@ -180,29 +369,93 @@ class Differ:
                 # If only one node has it, it means they are not the same.
                 return int(left.attrib.get(attr) == right.attrib.get(attr))
 
-        (leaf_weight, match) = self.leaf_ratio(left, right)
         (child_weight, child_ratio) = self.child_ratio(left, right)
 
-        if child_ratio is not None:
-            match = (leaf_weight * match + child_weight * child_ratio) / (
-                leaf_weight + child_weight
-            )
-        return match
+        key = (left, right)
+        leaf = self._ratio_cache.get(key)
+        if leaf is None:
+            if prune:
+                (leaf_weight, bound) = self.leaf_ratio_bound(left, right)
+                best = self._combine_ratios(
+                    leaf_weight, bound, child_weight, child_ratio
+                )
+                if best < self.F:
+                    # Even the best possible leaf ratio can't make these nodes
+                    # match, so we don't need the exact one.
+                    return best
+            leaf = self._ratio_cache[key] = self.leaf_ratio(left, right)
+        (leaf_weight, match) = leaf
+        return self._combine_ratios(leaf_weight, match, child_weight, child_ratio)
+
+    def _combine_ratios(self, leaf_weight, leaf_ratio, child_weight, child_ratio):
+        if child_ratio is None:
+            return leaf_ratio
+        return (leaf_weight * leaf_ratio + child_weight * child_ratio) / (
+            leaf_weight + child_weight
+        )
 
     def node_text(self, node):
         if node in self._text_cache:
             return self._text_cache[node]
         # Get the texts and the tag as a start
-        texts = node.xpath("text()")
+        if isinstance(node.tag, str):
+            texts = _TEXT_NODES(node)
+        else:
+            # The compiled query only accepts elements, not comments or PIs
+            texts = node.xpath("text()")
 
-        # Finally make one string, useful to see how similar two nodes are
-        text = " ".join(texts).strip()
-        result = utils.cleanup_whitespace(text)
+        # Finally make one string, useful to see how similar two nodes are.
+        # Collapsing the whitespace first leaves at most one space to strip.
+        result = utils.cleanup_whitespace(" ".join(texts)).strip()
         self._text_cache[node] = result
         return result
 
+    def node_tokens(self, node):
+        if node in self._token_cache:
+            return self._token_cache[node]
+        result = utils.splitString(self.node_text(node))
+        self._token_cache[node] = result
+        return result
+
+    def node_token_counts(self, node):
+        if node in self._token_count_cache:
+            return self._token_count_cache[node]
+        result = Counter(self.node_tokens(node))
+        self._token_count_cache[node] = result
+        return result
+
+    def node_chars(self, node):
+        # The node's tokens encoded with the shared vocabulary, or None when
+        # the vocabulary is full and can't encode them all.
+        if node in self._chars_cache:
+            return self._chars_cache[node]
+        chars = []
+        for token in self.node_tokens(node):
+            if token not in self._vocabulary:
+                if len(self._vocabulary) >= _VOCABULARY_SIZE:
+                    return None
+                # Like in utils.diff_wordsToChars, the first token is chr(1)
+                self._vocabulary[token] = chr(len(self._vocabulary) + 1)
+            chars.append(self._vocabulary[token])
+        result = "".join(chars)
+        self._chars_cache[node] = result
+        return result
+
     def node_weight(self, node):
-        return 1 + len(self.node_text(node))  # add 1 to account for the node itself
+        if node in self._weight_cache:
+            return self._weight_cache[node]
+        result = 1 + len(self.node_text(node))  # add 1 to account for the node itself
+        self._weight_cache[node] = result
+        return result
+
+    def child_weight(self, node):
+        if node in self._child_weight_cache:
+            return self._child_weight_cache[node]
+        result = 0
+        for child in node:
+            result += self.node_weight(child)
+        self._child_weight_cache[node] = result
+        return result
 
     def node_attribs(self, node):
         """Return a dict of attributes to consider for this node."""
@@ -221,11 +474,18 @@ class Differ:
                 return (0, 0)
         if len(ltext) == 0 or len(rtext) == 0:
             return (max(len(ltext), len(rtext)), 0)
-
-        tokenListLeft = utils.splitString(ltext)
-        tokenListRight = utils.splitString(rtext)
-
-        char1, char2, wa = utils.diff_wordsToChars(tokenListLeft, tokenListRight)
+        if ltext == rtext:
+            # Unchanged text, no need to diff it
+            return (len(ltext), 1.0)
+
+        # The vocabulary is shared, so the texts don't need a common mapping
+        char1 = self.node_chars(left)
+        char2 = self.node_chars(right)
+        if char1 is None or char2 is None:
+            # The vocabulary is full, fall back to a mapping of this pair only
+            char1, char2, _ = utils.diff_wordsToChars(
+                self.node_tokens(left), self.node_tokens(right)
+            )
 
         diff = self.dmp.diff_main(char1, char2)
         total_weight = max(
@@ -237,38 +497,74 @@ class Differ:
             1 - self.dmp.diff_levenshtein(diff) / total_weight,
         )
 
+    def leaf_ratio_bound(self, left, right):
+        # A cheap upper bound of leaf_ratio: the texts can't share more
+        # tokens than their common multiset of tokens.
+        ltext = self.node_text(left)
+        rtext = self.node_text(right)
+
+        if len(ltext) == 0 or len(rtext) == 0 or ltext == rtext:
+            # No text diff involved, the exact ratio is cheap
+            return self.leaf_ratio(left, right)
+
+        ltokens = self.node_tokens(left)
+        rtokens = self.node_tokens(right)
+        # The levenshtein distance is at least the difference in length
+        lengths = sorted((len(ltokens), len(rtokens)))
+        bound = lengths[0] / lengths[1]
+        # This is SequenceMatcher.quick_ratio(), with the token counts of
+        # each node computed once rather than for every pair.
+        lcounts = self.node_token_counts(left)
+        rcounts = self.node_token_counts(right)
+        if len(lcounts) > len(rcounts):
+            lcounts, rcounts = rcounts, lcounts
+        common = 0
+        for token, count in lcounts.items():
+            rcount = rcounts.get(token)
+            if rcount:
+                common += min(count, rcount)
+        bound = min(bound, 2.0 * common / (lengths[0] + lengths[1]))
+        return (max(len(rtext), len(ltext)), bound)
+
     def child_ratio(self, left, right):
         # How similar the children of two nodes are
-        left_children = left.getchildren()
-        right_children = right.getchildren()
-        if not left_children and not right_children:
+        if not len(left) and not len(right):
             return (0, None)
-        total_weight = 0
-        for child in left_children:
-            total_weight += self.node_weight(child)
-        for child in right_children:
-            total_weight += self.node_weight(child)
+        # The ratio itself depends on the current matches, so it can't be
+        # cached, but the weights of the children don't.
+        total_weight = self.child_weight(left) + self.child_weight(right)
 
         equal_weight = 0
-        for lchild in left_children:
-            for (
-                rchild
-            ) in right_children:  # TODO : find a better way to do this (getparent() ?)
-                if self._l2rmap.get(id(lchild)) is rchild:
-                    equal_weight += self.node_weight(lchild) + self.node_weight(rchild)
-                    right_children.remove(rchild)
-                    break
+        unmatched = set(right)
+        for lchild in left:
+            rchild = self._l2rmap.get(id(lchild))
+            if rchild in unmatched:
+                equal_weight += self.node_weight(lchild) + self.node_weight(rchild)
+                unmatched.discard(rchild)
 
         return (total_weight / 2, equal_weight / total_weight)
 
+    def _getpath(self, node):
+        # The path of a node only changes when the left tree is restructured,
+        # which clears the cache.
+        result = self._xpath_cache.get(node)
+        if result is None:
+            result = self._xpath_cache[node] = utils.getpath(node)
+        return result
+
     def update_node_tag(self, left, right):
         if left.tag != right.tag:
-            left_xpath = utils.getpath(left)
+            left_xpath = self._getpath(left)
             yield actions.RenameNode(left_xpath, right.tag)
             left.tag = right.tag
+            self._xpath_cache.clear()
 
     def update_node_attr(self, left, right):
-        left_xpath = utils.getpath(left)
+        if left.attrib == right.attrib:
+            # Most nodes have no attributes at all, nothing to update
+            return
+
+        left_xpath = self._getpath(left)
 
         # Update: Look for differences in attributes
 
@@ -277,32 +573,40 @@ class Differ:
         new_keys = right_keys.difference(left_keys)
         removed_keys = left_keys.difference(right_keys)
         common_keys = left_keys.intersection(right_keys)
+        # The right node isn't modified, read its attributes only once
+        left_attrib = left.attrib
+        right_values = dict(right.attrib)
 
         # We sort the attributes to get a consistent order in the edit script.
         # That's only so we can do testing in a reasonable way...
         for key in sorted(common_keys):
-            if left.attrib[key] != right.attrib[key]:
-                yield actions.UpdateAttrib(left_xpath, key, right.attrib[key])
-                left.attrib[key] = right.attrib[key]
+            value = right_values[key]
+            if left_attrib[key] != value:
+                yield actions.UpdateAttrib(left_xpath, key, value)
+                left_attrib[key] = value
 
         # Align: Not needed here, we don't care about the order of
         # attributes.
 
         # Insert: Find new attributes
         for key in sorted(new_keys):
-            yield actions.InsertAttrib(left_xpath, key, right.attrib[key])
-            left.attrib[key] = right.attrib[key]
+            value = right_values[key]
+            yield actions.InsertAttrib(left_xpath, key, value)
+            left_attrib[key] = value
 
         # Delete: remove removed attributes
         for key in sorted(removed_keys):
-            if key not in left.attrib:
+            if key not in left_attrib:
                 # This was already moved
                 continue
             yield actions.DeleteAttrib(left_xpath, key)
-            del left.attrib[key]
+            del left_attrib[key]
 
     def update_node_text(self, left, right):
-        left_xpath = utils.getpath(left)
+        if left.text == right.text and left.tail == right.tail:
+            return
+
+        left_xpath = self._getpath(left)
 
         if left.text != right.text:
             yield actions.UpdateTextIn(left_xpath, right.text)
@@ -313,20 +617,18 @@ class Differ:
             left.tail = right.tail
 
     def find_pos(self, node):
-        parent = node.getparent()
         # The paper here first checks if the child is the first child in
         # order, but I am entirely unable to actually make that happen, and
         # if it does, the "else:" will catch that case anyway, and it also
         # deals with the case of no child being in order.
 
         # Find the last sibling before the child that is in order
-        i = parent.index(node)
-        while i >= 1:
-            i -= 1
-            sibling = parent[i]
+        sibling = node.getprevious()
+        while sibling is not None:
             if sibling in self._inorder:
                 # That's it
                 break
+            sibling = sibling.getprevious()
         else:
             # No previous sibling in order.
             return 0
@@ -336,7 +638,7 @@ class Differ:
         node_match = self._r2lmap.get(id(node))
 
         i = 0
-        for child in sibling_match.getparent().getchildren():
+        for child in sibling_match.getparent():
             if child is node_match:
                 # Don't count the node we're looking for.
                 continue
@@ -351,12 +653,12 @@ class Differ:
     def align_children(self, left, right):
         lchildren = [
             c
-            for c in left.getchildren()
+            for c in left
             if (id(c) in self._l2rmap and self._l2rmap[id(c)].getparent() is right)
         ]
         rchildren = [
             c
-            for c in right.getchildren()
+            for c in right
             if (id(c) in self._r2lmap and self._r2lmap[id(c)].getparent() is left)
         ]
         if not lchildren or not rchildren:
@@ -383,11 +685,12 @@ class Differ:
             rtarget = rchild.getparent()
             ltarget = self._r2lmap[id(rtarget)]
             yield actions.MoveNode(
-                utils.getpath(lchild), utils.getpath(ltarget), right_pos
+                self._getpath(lchild), self._getpath(ltarget), right_pos
             )
             # Do the actual move:
             left.remove(lchild)
             ltarget.insert(right_pos, lchild)
+            self._xpath_cache.clear()
             # Mark the nodes as in order
             self._inorder.add(lchild)
             self._inorder.add(rchild)
@@ -400,9 +703,9 @@ class Differ:
         # The paper talks about the five phases, and then does four of them
         # in one phase, in a different order that described. This
         # implementation in turn differs in order yet again.
-        ltree = self.left.getroottree()
+        self._xpath_cache.clear()
 
-        for rnode in utils.breadth_first_traverse(self.right):
+        for rnode in self._right_nodes_breadth_first():
             # (a)
             rparent = rnode.getparent()
             ltarget = self._r2lmap.get(id(rparent))
@@ -414,14 +717,13 @@ class Differ:
 
                 # (ii)
 
-                yield actions.InsertNode(  # utils.getpath(ltarget, ltree)
-                    utils.getpath(ltarget, ltree), rnode.tag, pos
-                )
+                yield actions.InsertNode(self._getpath(ltarget), rnode.tag, pos)
                 lnode = ltarget.makeelement(rnode.tag)
 
                 # (iii)
                 self.append_match(lnode, rnode)
                 ltarget.insert(pos, lnode)
+                self._xpath_cache.clear()
                 self._inorder.add(lnode)
                 self._inorder.add(rnode)
                 # And then we update attributes. This is different from the
@@ -443,11 +745,12 @@ class Differ:
                 if ltarget is not lparent:
                     pos = self.find_pos(rnode)
                     yield actions.MoveNode(
-                        utils.getpath(lnode, ltree), utils.getpath(ltarget, ltree), pos
+                        self._getpath(lnode), self._getpath(ltarget), pos
                     )
                     # Move the node from current parent to target
                     lparent.remove(lnode)
                     ltarget.insert(pos, lnode)
+                    self._xpath_cache.clear()
                     self._inorder.add(lnode)
                     self._inorder.add(rnode)
 
@@ -472,5 +775,6 @@ class Differ:
         for lnode in utils.reverse_post_order_traverse(self.left):
             if id(lnode) not in self._l2rmap:
                 # No match
-                yield actions.DeleteNode(utils.getpath(lnode, ltree))
+                yield actions.DeleteNode(self._getpath(lnode))
                 lnode.getparent().remove(lnode)
+                self._xpath_cache.clear()
@@ -1,12 +1,21 @@
 import re
 
 from copy import deepcopy
+from itertools import islice
 from lxml import etree
 from . import utils, diff_match_patch, placeholder
 
 
 DIFF_NS = "http://namespaces.shoobx.com/diff"
 DIFF_PREFIX = "diff"
+# The registry is global to lxml, so this only needs to be done once.
+etree.register_namespace(DIFF_PREFIX, DIFF_NS)
+
+# Qualified names of the diff attributes, to not rebuild them for each action
+_DIFF_ATTR_NAMES = {
+    action: f"{{{DIFF_NS}}}{action}-attr" for action in ("add", "delete", "update")
+}
+_CHANGE_TARGET_NAME = f"{{{DIFF_NS}}}change-target"
 
 
 # Flags for whitespace handling in the text aware formatters:
@@ -16,6 +25,22 @@ WS_TAGS = 1  # Delete ignorable whitespace (between tags)
 WS_NONE = 0  # Preserve all whitespace
 
 
+def _placeholder_bit(ph):
+    # Placeholders are allocated in order from PLACEHOLDER_START, so each
+    # one gets its own bit, in the same order.
+    return 1 << (ord(ph) - placeholder.PLACEHOLDER_START)
+
+
+def _mask_placeholders(mask):
+    # The placeholders of a mask, in increasing order
+    result = []
+    while mask:
+        bit = mask & -mask
+        result.append(chr(placeholder.PLACEHOLDER_START + bit.bit_length() - 1))
+        mask ^= bit
+    return result
+
+
 class BaseFormatter:
     def __init__(self, normalize=WS_TAGS, pretty_print=False):
         """Formatters must as a minimum have a normalize parameter
@@ -107,6 +132,15 @@ class XMLFormatter(BaseFormatter):
             text_tags=text_tags, formatting_tags=formatting_tags
         )
         self.dmp = diff_match_patch.diff_match_patch()
+        # Compiled xpath steps, by path and namespaces
+        self._xpath_cache = {}
+        # Deleted children offsets, by parent, until its children change
+        self._delete_offsets = {}
+        # Bitmask of the link placeholders, and how many placeholders it covers
+        self._link_mask = 0
+        self._link_mask_size = 0
+        # Formatting changes of whole states, by action and state
+        self._modified_masks = {}
 
     def prepare(self, left_tree, right_tree):
         """prepare() is run on the trees before diffing
@@ -119,7 +153,6 @@ class XMLFormatter(BaseFormatter):
         self.placeholderer.do_tree(left_tree)
         self.placeholderer.do_tree(right_tree)
 
-        etree.register_namespace(DIFF_PREFIX, DIFF_NS)
         etree.cleanup_namespaces(left_tree, top_nsmap={DIFF_PREFIX: DIFF_NS})
         etree.cleanup_namespaces(right_tree, top_nsmap={DIFF_PREFIX: DIFF_NS})
 
@@ -130,6 +163,9 @@ class XMLFormatter(BaseFormatter):
         self.placeholderer.undo_tree(result_tree)
 
     def format(self, diff, orig_tree):
+        self._delete_offsets = {}
+        # As in Differ.set_trees, lxml's deepcopy is faster than a
+        # tostring/fromstring round trip, and keeps the tree as it is.
         result = deepcopy(orig_tree)
         if isinstance(result, etree._ElementTree):
             root = result.getroot()
@@ -145,7 +181,9 @@ class XMLFormatter(BaseFormatter):
         return self.render(result)
 
     def render(self, result):
-        return etree.tounicode(result, pretty_print=self.pretty_print)
+        return etree.tostring(
+            result, encoding="unicode", pretty_print=self.pretty_print
+        )
 
     def handle_action(self, action, result):
         action_type = type(action)
@@ -153,7 +191,9 @@ class XMLFormatter(BaseFormatter):
         method(action, result)
 
     def _remove_comments(self, tree):
-        comments = tree.xpath("//comment()")
+        # Iterating the comments doesn't need an xpath query. The list is
+        # made first so the tree isn't changed while iterating.
+        comments = list(tree.iter(etree.Comment))
 
         for element in comments:
             parent = element.getparent()
@@ -163,11 +203,47 @@ class XMLFormatter(BaseFormatter):
                 continue
             parent.remove(element)
 
+    def _compile_xpath(self, path, nsmap):
+        key = (path, tuple(nsmap.items()))
+        compiled = self._xpath_cache.get(key)
+        if compiled is None:
+            compiled = self._xpath_cache[key] = etree.XPath(path, namespaces=nsmap)
+        return compiled
+
     def _xpath(self, node, xpath):
         # This method finds an element with xpath and makes sure that
         # one and exactly one element is found. This is to protect against
         # formatting a diff on the wrong tree, or against using ambiguous
         # edit script xpaths.
+        # Skipping the deleted nodes at each step of the path lets libxml2
+        # find the element in one query. That can only be done when every
+        # step is indexed, otherwise a step matching several nodes must be
+        # reported as ambiguous. The root of an absolute path is unique.
+        # If the query doesn't find exactly one element, or can't be used,
+        # we go step by step, to know where it went wrong.
+        namespace, _, local_name = self.placeholderer.DELETE_NAME[1:].partition("}")
+        not_deleted = "[not(@*[namespace-uri()='%s' and local-name()='%s'])]" % (
+            namespace,
+            local_name,
+        )
+        steps = []
+        for position, step in enumerate(xpath.split("/")):
+            if step:
+                name, bracket, index = step.partition("[")
+                if not bracket and not (position == 1 and xpath[0] == "/"):
+                    return self._xpath_steps(node, xpath)
+                step = name + not_deleted + bracket + index
+            steps.append(step)
+        compiled = self._compile_xpath("/".join(steps), node.nsmap)
+        try:
+            matches = compiled(node)
+        except etree.XPathEvalError:
+            matches = []
+        if len(matches) == 1:
+            return matches[0]
+        return self._xpath_steps(node, xpath)
+
+    def _xpath_steps(self, node, xpath):
         if xpath[0] == "/":
             root = True
             xpath = xpath[1:]
@@ -191,8 +267,9 @@ class XMLFormatter(BaseFormatter):
         if root:
             path = "/" + path
 
+        compiled = self._compile_xpath(path, node.nsmap)
         matches = []
-        for match in node.xpath(path, namespaces=node.nsmap):
+        for match in compiled(node):
             # Skip nodes that have been deleted
             if self.placeholderer.DELETE_NAME not in match.attrib:
                 matches.append(match)
@@ -211,11 +288,11 @@ class XMLFormatter(BaseFormatter):
             )
         match = matches[index]
         if rest:
-            return self._xpath(match, rest)
+            return self._xpath_steps(match, rest)
         return match
 
     def _extend_diff_attr(self, node, action, value):
-        diffattr = f"{{{DIFF_NS}}}{action}-attr"
+        diffattr = _DIFF_ATTR_NAMES[action]
         oldvalue = node.attrib.get(diffattr, "")
         if oldvalue:
             value = oldvalue + ";" + value
@@ -231,6 +308,7 @@ class XMLFormatter(BaseFormatter):
 
     def _delete_node(self, node):
         node.attrib[self.placeholderer.DELETE_NAME] = ""
+        self._delete_offsets.pop(node.getparent(), None)
 
     def _handle_DeleteNode(self, action, tree):
         node = self._xpath(tree, action.node)
@@ -247,21 +325,27 @@ class XMLFormatter(BaseFormatter):
     def _insert_node(self, target, node, position):
         node.attrib[self.placeholderer.INSERT_NAME] = ""
         target.insert(position, node)
+        self._delete_offsets.pop(target, None)
 
     def _get_real_insert_position(self, target, position):
-        # Find the real position:
-        pos = 0
-        offset = 0
-        for child in target.getchildren():
-            if self.placeholderer.DELETE_NAME in child.attrib:
-                offset += 1
-            else:
-                pos += 1
-            if pos > position:
-                # We found the right offset
-                break
+        # Find the real position, by counting the deleted children up to
+        # the child at that position. The counts are kept for each
+        # position until the children of target change.
+        offsets = self._delete_offsets.get(target)
+        if offsets is None:
+            offsets = []
+            offset = 0
+            delete_name = self.placeholderer.DELETE_NAME
+            for child in target:
+                if child.get(delete_name) is not None:
+                    offset += 1
+                else:
+                    offsets.append(offset)
+            # Past the last child, all deleted children are counted
+            offsets.append(offset)
+            self._delete_offsets[target] = offsets
         # Real position
-        return position + offset
+        return position + offsets[min(position, len(offsets) - 1)]
 
     def _handle_InsertNode(self, action, tree):
         # Insert node as a child. However, position is the position in the
@@ -298,59 +382,71 @@ class XMLFormatter(BaseFormatter):
 
     def _get_content_and_states(self, contentArray):
         # remove placeholders (except PH of single type) from array and remember the position of opening/closing placeholders
+        # The states are bitmasks of the opened placeholders
         result = []
         stateByIndex = {}
         currentState = {}
+        mask = 0
         open_close_map = {}
+        # Placeholders are single characters, so they can be looked up directly
+        placeholder2tag = self.placeholderer.placeholder2tag
+        T_OPEN = self.placeholderer.T_OPEN
+        T_CLOSE = self.placeholderer.T_CLOSE
+        T_SINGLE = self.placeholderer.T_SINGLE
 
         for char in contentArray:
-            if self.placeholderer.is_placeholder(char):
-                entry = self.placeholderer.placeholder2tag[char]
-                if entry.ttype == self.placeholderer.T_SINGLE:
+            if char in placeholder2tag:
+                entry = placeholder2tag[char]
+                if entry.ttype == T_SINGLE:
                     result.append(char)
-                elif entry.ttype == self.placeholderer.T_OPEN:
+                elif entry.ttype == T_OPEN:
                     open_close_map[char] = entry.close_ph
                     open_close_map[entry.close_ph] = char
                     if char not in currentState:
                         currentState[char] = 0
                     currentState[char] += 1
-                    stateByIndex[len(result)] = deepcopy(currentState)
-                elif entry.ttype == self.placeholderer.T_CLOSE:
+                    if currentState[char] > 0:
+                        mask |= _placeholder_bit(char)
+                    stateByIndex[len(result)] = mask
+                elif entry.ttype == T_CLOSE:
                     open_char = open_close_map[char]
                     currentState[open_char] -= 1
-                    stateByIndex[len(result)] = deepcopy(currentState)
+                    if currentState[open_char] <= 0:
+                        # forget nested levels, the placeholder is closed
+                        mask &= ~_placeholder_bit(open_char)
+                    stateByIndex[len(result)] = mask
             else:
                 result.append(char)
         return result, stateByIndex
 
-    def _update_state(self, currentState, stateByIndex, index):
-        #  update currentState with the (sparse) stateByIndex
-        if index not in stateByIndex:
-            return currentState
-        else:
-            newState = stateByIndex[
-                index
-            ]  # do not keep placeholders with level == 0, and forget nested level
-            return set(filter(lambda key: newState[key] > 0, newState.keys()))
+    def _get_link_mask(self):
+        # Placeholders are only ever added, in order, so only the new ones
+        # need to be checked.
+        placeholder2tag = self.placeholderer.placeholder2tag
+        if self._link_mask_size < len(placeholder2tag):
+            new_entries = islice(placeholder2tag.items(), self._link_mask_size, None)
+            for ph, entry in new_entries:
+                if entry.element.tag == "a":
+                    self._link_mask |= _placeholder_bit(ph)
+            self._link_mask_size = len(placeholder2tag)
+        return self._link_mask
 
     def _merge_link_placeholders(  # TODO : create a placeholder map for merged placeholders
         self, commonPlaceholders, insertedPlaceholders, deletedPlaceholders
     ):
-        def _is_link_element(ph):
-            return self.placeholderer.placeholder2tag[ph].element.tag == "a"
-
-        insertedLinks = list(filter(_is_link_element, insertedPlaceholders))
+        links = self._get_link_mask()
+        insertedLinks = _mask_placeholders(insertedPlaceholders & links)
         if len(insertedLinks) == 0:
-            return
+            return commonPlaceholders, insertedPlaceholders, deletedPlaceholders
 
-        removedLinks = list(filter(_is_link_element, deletedPlaceholders))
+        removedLinks = _mask_placeholders(deletedPlaceholders & links)
         if len(removedLinks) == 0:
-            return
+            return commonPlaceholders, insertedPlaceholders, deletedPlaceholders
 
         insertedLinkPH = insertedLinks.pop()
         removedLinkPH = removedLinks.pop()
-        insertedPlaceholders.remove(insertedLinkPH)
-        deletedPlaceholders.remove(removedLinkPH)
+        insertedPlaceholders &= ~_placeholder_bit(insertedLinkPH)
+        deletedPlaceholders &= ~_placeholder_bit(removedLinkPH)
 
         newElement = etree.Element("a")
         oldHref = self.placeholderer.placeholder2tag[removedLinkPH].element.attrib[
@@ -360,48 +456,61 @@ class XMLFormatter(BaseFormatter):
             "href"
         ]
         if oldHref == newHref:
-            commonPlaceholders.add(removedLinkPH)
+            commonPlaceholders |= _placeholder_bit(removedLinkPH)
         else:
-            newElement.attrib[f"{{{DIFF_NS}}}" + "change-target"] = (
-                oldHref + " -> " + newHref
-            )
+            newElement.attrib[_CHANGE_TARGET_NAME] = oldHref + " -> " + newHref
 
             (ph_open, ph_close) = self.placeholderer.get_both_placeholders(newElement)
-            commonPlaceholders.add(ph_open)
+            commonPlaceholders |= _placeholder_bit(ph_open)
+        return commonPlaceholders, insertedPlaceholders, deletedPlaceholders
 
     def _merge_states(self, leftState, rightState):
         commonPlaceholders = leftState & rightState
-        insertedPlaceholders = rightState - leftState
-        deletedPlaceholders = leftState - rightState
-
-        self._merge_link_placeholders(
+        insertedPlaceholders = rightState & ~leftState
+        deletedPlaceholders = leftState & ~rightState
+        if not insertedPlaceholders and not deletedPlaceholders:
+            return commonPlaceholders
+
+        (
+            commonPlaceholders,
+            insertedPlaceholders,
+            deletedPlaceholders,
+        ) = self._merge_link_placeholders(
             commonPlaceholders, insertedPlaceholders, deletedPlaceholders
         )
 
         mergedState = commonPlaceholders
-        mergedState.update(
-            map(
-                lambda ph: self.placeholderer.get_modified_ph(ph, "insert-formatting"),
-                insertedPlaceholders,
-            )
-        )
-        mergedState.update(
-            map(
-                lambda ph: self.placeholderer.get_modified_ph(ph, "delete-formatting"),
-                deletedPlaceholders,
-            )
+        mergedState |= self._get_modified_mask(
+            insertedPlaceholders, "insert-formatting"
         )
+        mergedState |= self._get_modified_mask(deletedPlaceholders, "delete-formatting")
         return mergedState
 
+    def _get_modified_mask(self, mask, action):
+        # The same placeholders are modified again and again as long as the
+        # formatting differs, and get_modified_ph always returns the same
+        # placeholder for them.
+        key = (mask, action)
+        modified = self._modified_masks.get(key)
+        if modified is None:
+            modified = 0
+            for ph in _mask_placeholders(mask):
+                ph = self.placeholderer.get_modified_ph(ph, action)
+                modified |= _placeholder_bit(ph)
+            self._modified_masks[key] = modified
+        return modified
+
     def _insert_spacing(self, tokenList):
         output = []
         pendingSpace = False
+        placeholder2tag = self.placeholderer.placeholder2tag
+        T_OPEN = self.placeholderer.T_OPEN
 
         for token in tokenList:
-            if self.placeholderer.is_placeholder(token):
+            if token in placeholder2tag:
                 if pendingSpace:
-                    entry = self.placeholderer.placeholder2tag[token]
-                    if entry.ttype == self.placeholderer.T_OPEN:
+                    entry = placeholder2tag[token]
+                    if entry.ttype == T_OPEN:
                         output.append(" ")
                         pendingSpace = False
             else:  # This is a word
@@ -419,65 +528,54 @@ class XMLFormatter(BaseFormatter):
         diffMungedWords = self.dmp.diff_main(char1, char2)
         diffWords = utils.diff_charsToWords(diffMungedWords, wordsArray)
 
-        stateByIndex = {}
         leftIndex = 0
         rightIndex = 0
-        currentLeftState = set()
-        currentRightState = set()
-        stateByIndex = []
-
-        for (
-            op,
-            _,
-        ) in diffWords:  # create a list with the state of each token in the output
+        currentLeftState = 0
+        currentRightState = 0
+        stateByIndex = [None] * len(diffWords)
+        insert_bit = _placeholder_bit(self.placeholderer.diff_tags["insert"][0])
+        delete_bit = _placeholder_bit(self.placeholderer.diff_tags["delete"][0])
+
+        # create a list with the state of each token in the output
+        for i, (op, _) in enumerate(diffWords):
             if op == 0:  #  equal content
-                currentLeftState = self._update_state(
-                    currentLeftState, leftStateByIndex, leftIndex
-                )
-                currentRightState = self._update_state(
-                    currentRightState, rightStateByIndex, rightIndex
-                )
+                currentLeftState = leftStateByIndex.get(leftIndex, currentLeftState)
+                currentRightState = rightStateByIndex.get(rightIndex, currentRightState)
                 commonState = self._merge_states(currentLeftState, currentRightState)
-                stateByIndex.append(commonState)
+                stateByIndex[i] = commonState
                 leftIndex += 1
                 rightIndex += 1
             elif op == 1:  #  insertion
-                currentRightState = self._update_state(
-                    currentRightState, rightStateByIndex, rightIndex
-                )
-                state = deepcopy(currentRightState)
-                state.add(self.placeholderer.diff_tags["insert"][0])
-                stateByIndex.append(state)
+                currentRightState = rightStateByIndex.get(rightIndex, currentRightState)
+                stateByIndex[i] = currentRightState | insert_bit
                 rightIndex += 1
             elif op == -1:  #  deletion
-                currentLeftState = self._update_state(
-                    currentLeftState, leftStateByIndex, leftIndex
-                )
-                state = deepcopy(currentLeftState)
-                state.add(self.placeholderer.diff_tags["delete"][0])
-                stateByIndex.append(state)
+                currentLeftState = leftStateByIndex.get(leftIndex, currentLeftState)
+                stateByIndex[i] = currentLeftState | delete_bit
                 leftIndex += 1
 
-        oldState = set()
+        placeholder2tag = self.placeholderer.placeholder2tag
+        oldState = 0
         splitOutput = []
         currentOpenedPH = []
         for i in range(
             0, len(stateByIndex)
         ):  # reinsert placeholders in the text, paying attention to the order of insertion
             newState = stateByIndex[i]
-            openedPH = newState - oldState
-            closedPH = oldState - newState
-            phToReopen = set()
+            openedPH = newState & ~oldState
+            closedPH = oldState & ~newState
+            phToReopen = 0
             while closedPH:
                 last_ph_opened = currentOpenedPH.pop()
-                entry = self.placeholderer.placeholder2tag[last_ph_opened]
+                entry = placeholder2tag[last_ph_opened]
                 splitOutput.append(entry.close_ph)
-                if last_ph_opened in closedPH:
-                    closedPH.remove(last_ph_opened)
+                bit = _placeholder_bit(last_ph_opened)
+                if closedPH & bit:
+                    closedPH &= ~bit
                 else:
-                    phToReopen.add(last_ph_opened)
-            for ph in sorted(
-                openedPH | phToReopen, reverse=True
+                    phToReopen |= bit
+            for ph in reversed(
+                _mask_placeholders(openedPH | phToReopen)
             ):  # order tags to get more meaningful semantics
                 currentOpenedPH.append(ph)
                 splitOutput.append(ph)
@@ -486,7 +584,7 @@ class XMLFormatter(BaseFormatter):
 
         while currentOpenedPH:  # close tags still open at the end
             ph = currentOpenedPH.pop()
-            entry = self.placeholderer.placeholder2tag[ph]
+            entry = placeholder2tag[ph]
             splitOutput.append(entry.close_ph)
 
         return "".join(self._insert_spacing(splitOutput))
@@ -496,12 +594,11 @@ class XMLFormatter(BaseFormatter):
             left_value = utils.cleanup_whitespace(left_value or "").strip()
             right_value = utils.cleanup_whitespace(right_value or "").strip()
 
-        leftValueArray = utils.splitString(
-            left_value or "", self.placeholderer.placeholder2tag.keys()
-        )
-        rightValueArray = utils.splitString(
-            right_value or "", self.placeholderer.placeholder2tag.keys()
-        )
+        # New placeholders are made while diffing, so this can't be kept
+        # between calls.
+        placeholders = frozenset(self.placeholderer.placeholder2tag)
+        leftValueArray = utils.splitString(left_value or "", placeholders)
+        rightValueArray = utils.splitString(right_value or "", placeholders)
         result = self._diff_rich_text(leftValueArray, rightValueArray)
         if update_tail:
             node.tail = result
@@ -1,10 +1,20 @@
 from . import formatting, placeholder
-from copy import deepcopy
 from lxml import etree
 import lxml
 
 
 class HTMLFormatter(formatting.XMLFormatter):
+    # Qualified names of the diff markup, to not rebuild them for each element
+    DIFF_INSERT = placeholder.PlaceholderMaker.INSERT_NAME
+    DIFF_DELETE = placeholder.PlaceholderMaker.DELETE_NAME
+    DIFF_MOVE = placeholder.PlaceholderMaker.MOVE_NAME
+    DIFF_RENAME = placeholder.PlaceholderMaker.RENAME_NAME
+    DIFF_CHANGE_TARGET = "{%s}change-target" % formatting.DIFF_NS
+    DIFF_INSERT_FORMATTING = "{%s}insert-formatting" % formatting.DIFF_NS
+    DIFF_DELETE_FORMATTING = "{%s}delete-formatting" % formatting.DIFF_NS
+    # The diff tags and the tags they are rendered as
+    DIFF_TAGS = {DIFF_DELETE: "delete", DIFF_INSERT: "insert"}
+
     def __init__(
         self,
         normalize=formatting.WS_NONE,
@@ -50,45 +60,54 @@ class HTMLFormatter(formatting.XMLFormatter):
         )
 
     def addClass(self, element, className):
-        if "class" in element.attrib:
-            element.set("class", element.get("class") + " " + className)
+        classes = element.get("class")
+        if classes is not None:
+            element.set("class", classes + " " + className)
         else:
             element.set("class", className)
 
     def modifyElement(self, element, state):
-        prefix = "{%s}" % "http://namespaces.shoobx.com/diff"
-        state = deepcopy(state)
-
-        if element.tag == prefix + "delete":
-            element.tag = "delete"
-        if element.tag == prefix + "insert":
-            element.tag = "insert"
-
-        if prefix + "move" in element.attrib:
+        # Walk the subtree with a stack instead of recursing. Each element
+        # gets the state its parent left.
+        stack = [(element, state)]
+        while stack:
+            element, state = stack.pop()
+            state = self.modifyNode(element, state)
+            stack.extend((child, state) for child in reversed(element))
+
+    def modifyNode(self, element, state):
+        # The state is shared with the parent, it is only copied before
+        # being changed.
+        attrib = element.attrib
+
+        tag = self.DIFF_TAGS.get(element.tag)
+        if tag is not None:
+            element.tag = tag
+
+        if self.DIFF_MOVE in attrib:
             self.addClass(element, "diff-moved")
 
-        if prefix + "rename" in element.attrib:
+        if self.DIFF_RENAME in attrib:
             self.addClass(element, "diff-renamed")
             self.addClass(element, "tooltipped")
-            element.set(
-                "aria-label", "Previous tag : " + element.get(prefix + "rename")
-            )
+            element.set("aria-label", "Previous tag : " + attrib[self.DIFF_RENAME])
 
-        if prefix + "insert" in element.attrib:
+        if self.DIFF_INSERT in attrib:
             self.addClass(element, "diff-inserted")
 
-        if prefix + "delete" in element.attrib:
+        if self.DIFF_DELETE in attrib:
             self.addClass(element, "diff-deleted")
 
-        if prefix + "change-target" in element.attrib:
+        if self.DIFF_CHANGE_TARGET in attrib:
             self.addClass(element, "diff-target-changed")
             self.addClass(element, "tooltipped ")
             element.set(
-                "aria-label", element.attrib[prefix + "change-target"],
+                "aria-label", attrib[self.DIFF_CHANGE_TARGET],
             )
 
-        if prefix + "insert-formatting" in element.attrib:
+        if self.DIFF_INSERT_FORMATTING in attrib:
             if element.tag == "a":
+                state = state.copy()
                 if "old-href" in state:
                     if state["old-href"] != element.get("href"):
                         self.addClass(element, "diff-target-changed")
@@ -112,7 +131,7 @@ class HTMLFormatter(formatting.XMLFormatter):
                     newElement.text = "↩"
                     element.addprevious(newElement)
 
-        if prefix + "delete-formatting" in element.attrib:
+        if self.DIFF_DELETE_FORMATTING in attrib:
             element.set("old-formatting", element.tag)
             oldTag = element.tag
             element.tag = "span"
@@ -121,6 +140,7 @@ class HTMLFormatter(formatting.XMLFormatter):
             element.set("aria-label", "Previous formatting : " + oldTag)
 
             if oldTag == "a":
+                state = state.copy()
                 if "new-href" in state:
                     if state["new-href"] != element.get("href"):
                         self.addClass(element, "diff-target-changed")
@@ -140,25 +160,26 @@ class HTMLFormatter(formatting.XMLFormatter):
             else:
                 self.addClass(element, "diff-deleted-formatting")
 
-        for child in element:
-            self.modifyElement(child, state)
+        return state
 
     def modifyTree(self, tree):
         self.modifyElement(tree, {})
 
     def cleanWhitespaceFormatting(self, tree):
-        for child in tree:
-            self.cleanWhitespaceFormatting(child)
-            if (
-                (
-                    child.tag in self.dual_formatting_tags
-                    or child.tag in self.complex_formatting_tags
-                    or child.tag in self.text_tags
-                )
-                and not len(child) > 0
-                and (not child.text or len(child.text.strip()) == 0)
-            ):
-                tree.remove(child)
+        tags = {
+            *self.dual_formatting_tags,
+            *self.complex_formatting_tags,
+            *self.text_tags,
+        }
+        if not tags:
+            # Without tags, iterdescendants() would return every element
+            return
+        # lxml only returns the elements with these tags. In reverse document
+        # order, all the descendants of a child are cleaned before the child
+        # itself is checked.
+        for child in reversed(list(tree.iterdescendants(*tags))):
+            if not len(child) > 0 and (not child.text or len(child.text.strip()) == 0):
+                child.getparent().remove(child)
 
     def render(self, result):
         self.cleanWhitespaceFormatting(result)
@@ -40,6 +40,6 @@ def _getBaseHTML(title, cssFiles):
 def display_diff_html(diff, title, stylesheets):
     base_html = _getBaseHTML(title, stylesheets)
     new_file = lxml.html.fromstring(base_html, parser=lxml.etree.HTMLParser())
-    default_body = new_file.xpath("//body")[0]
+    default_body = new_file.find(".//body")
     default_body.getparent().replace(default_body, diff)
     return new_file
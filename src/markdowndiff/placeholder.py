@@ -17,6 +17,51 @@ PLACEHOLDER_START = 0xE000
 PlaceholderEntry = namedtuple("PlaceholderEntry", "element ttype close_ph")
 
 
+def _clone_shallow(element):
+    """Copy an element without its text and tail
+
+    Placeholder tags rarely have children, so a new element with the same
+    tag and attributes is enough. Elements with children, and namespaced
+    elements that still sit in a tree (where only the namespaces they use
+    should be copied), go through deepcopy instead.
+    """
+    if element.getparent() is None and not len(element):
+        return etree.Element(element.tag, dict(element.items()), element.nsmap)
+    if len(element) or "{" in element.tag or any("{" in k for k in element.keys()):
+        copy = deepcopy(element)
+        copy.text = copy.tail = None
+        return copy
+    return etree.Element(element.tag, dict(element.items()))
+
+
+def _struct_key(element):
+    """Build the placeholder lookup key of an element
+
+    Placeholder tags are mostly leaves, for which the tag, the attributes and
+    the text identify them just as well as their canonical serialization does.
+    Elements with children are still canonicalized.
+    """
+    if len(element):
+        return etree.canonicalize(element)
+    return (element.tag, tuple(sorted(element.items())), element.text or "")
+
+
+def _clone_with_diff_attr(element, action):
+    """Copy a stored placeholder element with a diff action attribute
+
+    The stored elements have no parent, text or tail, so unless they have
+    children, a new element with the extra attribute is an exact copy.
+    """
+    name = f"{{{DIFF_NS}}}{action}"
+    if len(element):
+        copy = deepcopy(element)
+        copy.set(name, "")
+        return copy
+    attrib = dict(element.items())
+    attrib[name] = ""
+    return etree.Element(element.tag, attrib, element.nsmap)
+
+
 class PlaceholderMaker:
     """Replace tags with unicode placeholders
 
@@ -41,10 +86,15 @@ class PlaceholderMaker:
 
     def __init__(self, text_tags=(), formatting_tags=()):
         self.text_tags = text_tags
-        self.formatting_tags = formatting_tags
+        self.formatting_tags = frozenset(formatting_tags)
         self.placeholder2tag = {}
+        # The same entries, indexed by placeholder - PLACEHOLDER_START - 1
+        self._entries = []
         self.tag2placeholder = {}
         self.placeholder = PLACEHOLDER_START
+        self._modified_cache = {}
+        self._split_re = None
+        self._split_re_end = None
 
         insert_elem = etree.Element(self.INSERT_NAME)
         insert_close = self.get_placeholder(insert_elem, self.T_CLOSE, None)
@@ -60,47 +110,60 @@ class PlaceholderMaker:
         }
 
     def get_both_placeholders(self, element):
-        ph_close = self.get_placeholder(element, self.T_CLOSE, None)
-        ph_open = self.get_placeholder(element, self.T_OPEN, ph_close)
+        # Both placeholders share the element's key, build it only once
+        key = _struct_key(element)
+        ph_close = self._get_placeholder(key, element, self.T_CLOSE, None)
+        ph_open = self._get_placeholder(key, element, self.T_OPEN, ph_close)
         return (ph_open, ph_close)
 
     def get_placeholder(self, element, ttype, close_ph):
-        tag = etree.canonicalize(element)
+        return self._get_placeholder(_struct_key(element), element, ttype, close_ph)
+
+    def _get_placeholder(self, tag, element, ttype, close_ph):
         ph = self.tag2placeholder.get((tag, ttype, close_ph))
         if ph is not None:
             return ph
         self.placeholder += 1
         ph = chr(self.placeholder)
-        copy = deepcopy(element)
-        copy.tail = None
-        copy.text = None
-        self.placeholder2tag[ph] = PlaceholderEntry(copy, ttype, close_ph)
+        copy = _clone_shallow(element)
+        entry = PlaceholderEntry(copy, ttype, close_ph)
+        self.placeholder2tag[ph] = entry
+        self._entries.append(entry)
         self.tag2placeholder[tag, ttype, close_ph] = ph
         return ph
 
-    def get_modified_ph(self, ph, action):  ## TODO cache the results
+    def get_modified_ph(self, ph, action):
+        key = (ph, action)
+        modified = self._modified_cache.get(key)
+        if modified is None:
+            modified = self._modified_cache[key] = self._make_modified_ph(ph, action)
+        return modified
+
+    def _make_modified_ph(self, ph, action):
         entry = self.placeholder2tag[ph]
 
         # Mark the tag as having a diff-action. We do need to
         # make a copy of it and get a new placeholder:
-        elem = entry.element
-        elem = deepcopy(elem)
-        elem.attrib[f"{{{DIFF_NS}}}{action}"] = ""
+        elem = _clone_with_diff_attr(entry.element, action)
 
         # And make a new placeholder for this new entry:
         if entry.ttype == self.T_SINGLE:
             ph_single = self.get_placeholder(elem, self.T_SINGLE, None)
             return ph_single
 
-        ph_close = self.get_placeholder(elem, self.T_CLOSE, None)
+        key = _struct_key(elem)
+        ph_close = self._get_placeholder(key, elem, self.T_CLOSE, None)
         if entry.ttype == self.T_CLOSE:
             return ph_close
 
-        ph_open = self.get_placeholder(elem, self.T_OPEN, ph_close)
+        ph_open = self._get_placeholder(key, elem, self.T_OPEN, ph_close)
         return ph_open
 
     def is_placeholder(self, char):
-        return len(char) == 1 and char in self.placeholder2tag
+        return (
+            len(char) == 1
+            and 0 < ord(char) - PLACEHOLDER_START <= len(self._entries)
+        )
 
     def is_formatting(self, element):
         return element.tag in self.formatting_tags
@@ -109,110 +172,172 @@ class PlaceholderMaker:
         # Replace only formatting elements by text
         # if we have non formatting element followed by formatting elements, add formatting element into tail text
 
+        formatting_tags = self.formatting_tags
+        get_both_placeholders = self.get_both_placeholders
         previous_child = None
+        # The text pieces of element.text or of a tail, joined once at the end
+        parts = None
+        merged = []
 
         for child in element:
-            current_text = element.text or ""
             # Replace formatted nodes by text between two placeholders
-            if self.is_formatting(child):
+            if child.tag in formatting_tags:
                 self.do_element(child)
-                tail = child.tail or ""
-                if previous_child is not None:
-                    current_text = previous_child.tail or ""
-                (ph_open, ph_close) = self.get_both_placeholders(child)
-                text = child.text or ""
-                if previous_child is not None:
-                    previous_child.tail = (
-                        current_text + ph_open + text + ph_close + tail
-                    )
-                else:
-                    element.text = current_text + ph_open + text + ph_close + tail
+                if parts is None:
+                    if previous_child is None:
+                        parts = [element.text or ""]
+                    else:
+                        parts = [previous_child.tail or ""]
+                    merged.append((previous_child, parts))
+                (ph_open, ph_close) = get_both_placeholders(child)
+                parts += (ph_open, child.text or "", ph_close, child.tail or "")
                 # Remove the element from the tree now that we have inserted
                 # replacement text. "remove" also deletes the tail text
                 element.remove(child)
             else:
                 # Start modifiying the tail of this child
                 previous_child = child
+                parts = None
+
+        for previous_child, parts in merged:
+            if previous_child is None:
+                element.text = "".join(parts)
+            else:
+                previous_child.tail = "".join(parts)
 
     def do_tree(self, tree):
         if self.text_tags:
-            for elem in reversed(tree.xpath("//" + "|//".join(self.text_tags))):
+            for elem in reversed(list(tree.iter(*self.text_tags))):
                 self.do_element(elem)
 
+    def _get_placeholder_re(self):
+        # Placeholders are allocated one after the other, so they are all
+        # in a single character range that only grows at its end.
+        if self.placeholder != self._split_re_end:
+            regexp = "([%s-%s])" % (chr(PLACEHOLDER_START + 1), chr(self.placeholder))
+            self._split_re = re.compile(regexp, flags=re.MULTILINE)
+            self._split_re_end = self.placeholder
+        return self._split_re
+
     def split_string(self, text):
-        regexp = "([%s])" % "".join(self.placeholder2tag)
-        return re.split(regexp, text, flags=re.MULTILINE)
+        return self._get_placeholder_re().split(text)
 
     def undo_string(self, text):
-        result = etree.Element("wrap")
+        """Replace the placeholders of a text by their elements
+
+        Returns the text before the first element, and the elements, with
+        the text following each of them as their tail.
+        """
+        head = None
+        elements = []
         element = None
+        entries = self._entries
+        first = PLACEHOLDER_START + 1
+        # The text pieces of the head and of the tail of every element,
+        # joined once at the end
+        pieces = []
+        merged = [(None, pieces)]
 
         segments = self.split_string(text)
-        while segments:
-            seg = segments.pop(0)
+        i = 0
+        while i < len(segments):
+            seg = segments[i]
+            i += 1
             if not seg:
                 continue
 
             # Segments can be either plain string or placeholders.
-            if self.is_placeholder(seg):
-                entry = self.placeholder2tag[seg]
+            index = ord(seg) - first if len(seg) == 1 else -1
+            if 0 <= index < len(entries):
+                entry = entries[index]
                 if entry.ttype == self.T_OPEN:
                     element = deepcopy(entry.element)
-                    next_seg = segments.pop(0)
-                    new_text = ""
+                    start = i
+                    next_seg = segments[i]
                     nested = 0  # take into account nested tag of the same type.
                     while next_seg != entry.close_ph or nested != 0:
-                        new_text += next_seg
                         if next_seg == seg:
                             nested += 1
                         elif next_seg == entry.close_ph:
                             nested -= 1
-                        next_seg = segments.pop(0)
-                    element.text = new_text or ""
+                        i += 1
+                        next_seg = segments[i]
+                    element.text = "".join(segments[start:i])
+                    i += 1
                     self.undo_element(element)
-                    result.append(element)
+                    elements.append(element)
+                    pieces = []
+                    merged.append((element, pieces))
                 elif entry.ttype == self.T_SINGLE:
                     # single element have no childs
                     element = deepcopy(entry.element)
-                    result.append(element)
+                    elements.append(element)
+                    pieces = []
+                    merged.append((element, pieces))
+            else:
+                pieces.append(seg)
+
+        for element, pieces in merged:
+            if not pieces:
+                continue
+            if element is not None:
+                element.tail = "".join(pieces)
             else:
-                if element is not None:
-                    element.tail = element.tail or "" + seg
-                else:
-                    result.text = result.text or "" + seg
-        return result
+                head = "".join(pieces)
+        return head, elements
+
+    def _undo_text(self, elem):
+        head, children = self.undo_string(elem.text)
+        if elem.text != head:
+            # Placeholders was replaced
+            elem.text = head
+            for index, child in enumerate(children):
+                self.undo_element(child)
+                elem.insert(index, child)
+
+    def _undo_tail(self, elem):
+        head, children = self.undo_string(elem.tail)
+        if elem.tail != head:
+            # Placeholders was replaced
+            elem.tail = head
+            parent = elem.getparent()
+            index = parent.index(elem) + 1
+            for child in children:
+                self.undo_element(child)
+                parent.insert(index, child)
+                index += 1
 
     def undo_element(self, elem):
         if self.placeholder2tag:
-            if elem.text:
-                index = 0
-                content = self.undo_string(elem.text)
-
-                if elem.text != content.text:
-                    # Placeholders was replaced
-                    elem.text = content.text
-                    for child in content:
-                        self.undo_element(child)
-                        elem.insert(index, child)
-                        index += 1
+            # Most texts have no placeholders, and need no splitting
+            has_placeholder = self._get_placeholder_re().search
+            if elem.text and has_placeholder(elem.text):
+                self._undo_text(elem)
 
             for child in elem:
                 self.undo_element(child)
 
-            if elem.tail:
-                content = self.undo_string(elem.tail)
-                if elem.tail != content.text:
-                    # Placeholders was replaced
-                    elem.tail = content.text
-                    parent = elem.getparent()
-                    index = parent.index(elem) + 1
-                    for child in content:
-                        self.undo_element(child)
-                        parent.insert(index, child)
-                        index += 1
+            if elem.tail and has_placeholder(elem.tail):
+                self._undo_tail(elem)
 
     def undo_tree(self, tree):
-        self.undo_element(tree)
+        if not self.placeholder2tag:
+            return
+        # Walk the tree in C, and undo only the texts with placeholders. The
+        # elements are collected first, as undoing them inserts new elements,
+        # which are complete already.
+        has_placeholder = self._get_placeholder_re().search
+        texts = []
+        tails = []
+        for elem in tree.iter():
+            if elem.text and has_placeholder(elem.text):
+                texts.append(elem)
+            if elem.tail and has_placeholder(elem.tail):
+                tails.append(elem)
+        for elem in texts:
+            self._undo_text(elem)
+        for elem in tails:
+            self._undo_tail(elem)
 
 
 class HTMLPlaceholderMaker(PlaceholderMaker):
@@ -232,12 +357,15 @@ class HTMLPlaceholderMaker(PlaceholderMaker):
         text_tags=(),
     ):
         all_formatting_tags = []
-        all_formatting_tags.extend(list(single_formatting_tags))
-        all_formatting_tags.extend(list(dual_formatting_tags))
-        all_formatting_tags.extend(list(complex_formatting_tags))
+        all_formatting_tags.extend(single_formatting_tags)
+        all_formatting_tags.extend(dual_formatting_tags)
+        all_formatting_tags.extend(complex_formatting_tags)
         self.single_formatting_tags = single_formatting_tags
         self.dual_formatting_tags = dual_formatting_tags
         self.complex_formatting_tags = complex_formatting_tags
+        # The tag lists keep their order, but are looked up for every element
+        self._single_tags = frozenset(single_formatting_tags)
+        self._dual_tags = frozenset(dual_formatting_tags)
         super().__init__(formatting_tags=all_formatting_tags, text_tags=text_tags)
 
         for tag in self.dual_formatting_tags:  # create initial tags to ensure ordering
@@ -245,15 +373,12 @@ class HTMLPlaceholderMaker(PlaceholderMaker):
             self.get_both_placeholders(elem)
 
     def get_both_placeholders(self, element):
-        if element.tag in self.single_formatting_tags:
+        tag = element.tag
+        if tag in self._single_tags:
             ph_single = self.get_placeholder(element, self.T_SINGLE, None)
             return (ph_single, "")
-        elif element.tag in self.dual_formatting_tags:
-            elem = etree.Element(element.tag)
-            ph_close = self.get_placeholder(elem, self.T_CLOSE, None)
-            ph_open = self.get_placeholder(elem, self.T_OPEN, ph_close)
-            return (ph_open, ph_close)
+        elif tag in self._dual_tags:
+            # Dual tags drop their attributes, only the tag is kept
+            return super().get_both_placeholders(etree.Element(tag))
         else:
-            ph_close = self.get_placeholder(element, self.T_CLOSE, None)
-            ph_open = self.get_placeholder(element, self.T_OPEN, ph_close)
-            return (ph_open, ph_close)
+            return super().get_both_placeholders(element)
@@ -1,29 +1,19 @@
 import re
+from collections import deque
+from functools import lru_cache
 from operator import eq
 
 
+@lru_cache(maxsize=64)
+def _split_pattern(split_chars):
+    chars = re.escape("".join(sorted(split_chars)))
+    # Either a single split character or a run of other non-space characters
+    return re.compile("[%s]|[^ %s]+" % (chars, chars))
+
+
 def splitString(text, placeholderList=[]):
     # split text on spaces, punctuation and placeholder, and remove spaces.
-    # TODO : simplify this function
-    listCharsSplit = [";", "!", "?"]
-    listCharsSplit.extend(placeholderList)
-
-    output = []
-
-    stringStart = 0
-    for i in range(0, len(text)):
-        if text[i] in listCharsSplit:
-            if i > stringStart:
-                output.append(text[stringStart:i])
-            output.append(text[i])
-            stringStart = i + 1
-        if text[i] == " ":
-            if i > stringStart:
-                output.append(text[stringStart:i])
-            stringStart = i + 1
-    if stringStart < len(text):
-        output.append(text[stringStart:])
-    return output
+    return _split_pattern(frozenset(placeholderList).union(";!?")).findall(text)
 
 
 def diff_wordsToChars(tokenList1, tokenList2):
@@ -32,15 +22,15 @@ def diff_wordsToChars(tokenList1, tokenList2):
     wordsArray.append("")
 
     def diff_wordsToCharsMunge(tokens):
-        chars = []
+        get_index = wordsHash.setdefault
+        add_word = wordsArray.append
+        ids = []
         for token in tokens:
-            if token in wordsHash:
-                chars.append(chr(wordsHash[token]))
-            else:
-                wordsArray.append(token)
-                wordsHash[token] = len(wordsArray) - 1
-                chars.append(chr(len(wordsArray) - 1))
-        return "".join(chars)
+            index = get_index(token, len(wordsArray))
+            if index == len(wordsArray):
+                add_word(token)
+            ids.append(index)
+        return "".join(map(chr, ids))
 
     chars2 = diff_wordsToCharsMunge(tokenList2)
     chars1 = diff_wordsToCharsMunge(tokenList1)
@@ -57,32 +47,69 @@ def diff_charsToWords(diffs, lineArray):
 
 
 def post_order_traverse(node):
-    for child in node.getchildren():
-        # PY3: Man, I want yield from!
-        yield from post_order_traverse(child)
-    yield node
+    # lxml walks the tree in document order much faster than recursive
+    # generators can. The ancestors of the current node are kept on a stack,
+    # and each one is yielded once the walk has left its subtree.
+    stack = []
+    for item in node.iter():
+        if stack:
+            parent = item.getparent()
+            while stack[-1] is not parent:
+                yield stack.pop()
+        stack.append(item)
+    while stack:
+        yield stack.pop()
 
 
 def reverse_post_order_traverse(node):
-    for child in reversed(node.getchildren()):
-        # PY3: Man, I want yield from!
-        yield from reverse_post_order_traverse(child)
-    yield node
+    # This is exactly the document order, backwards
+    yield from reversed(list(node.iter()))
 
 
 def breadth_first_traverse(node):
     # First yield the root node
-    queue = [node]
+    queue = deque([node])
 
     while queue:
-        item = queue.pop(0)
+        item = queue.popleft()
         yield item
-        queue.extend(item.getchildren())
+        queue.extend(item)
+
+
+def _walk_back_snakes(trace, d, k, x):
+    # Rebuild the matches of the d-path ending at x on diagonal k, from the
+    # furthest x of the diagonals of every previous d.
+    matches = []
+    while True:
+        if d == 0:
+            # The 0-path starts at x = 0
+            mid_x = 0
+        else:
+            prev = trace[d - 1]
+            # prev[(j + d - 1) // 2] is the furthest x of diagonal j
+            if k == -d or (k != d and prev[(k + d - 2) // 2] < prev[(k + d) // 2]):
+                # Went down
+                prev_k = k + 1
+                prev_x = mid_x = prev[(k + d) // 2]
+            else:
+                # Went left
+                prev_k = k - 1
+                prev_x = prev[(k + d - 2) // 2]
+                mid_x = prev_x + 1
+        matches.extend((x, x - k) for x in range(x - 1, mid_x - 1, -1))
+        if d == 0:
+            break
+        d -= 1
+        k = prev_k
+        x = prev_x
+    matches.reverse()
+    return matches
 
 
 # LCS from Myers: An O(ND) Difference Algorithm and Its Variations. This
-# implementation uses Chris Marchetti's technique of only keeping the history
-# per dpath, and not per node, so it should be vastly less memory intensive.
+# implementation only keeps the furthest x of each diagonal per d, and walks
+# back from the end to find the matches, so it should be vastly less memory
+# intensive.
 # It also skips any items that are equal in the beginning and end, speeding
 # up the search, and using even less memory.
 def longest_common_subsequence(left_sequence, right_sequence, eqfn=eq):
@@ -113,31 +140,32 @@ def longest_common_subsequence(left_sequence, right_sequence, eqfn=eq):
 
     lmax = len(left)
     rmax = len(right)
-    furthest = {1: (0, [])}
 
     if not lmax + rmax:
         # The sequences are equal
         r = range(lslen)
         return zip(r, r)
 
+    # The furthest x of every diagonal k, stored at k + offset
+    offset = lmax + rmax + 1
+    furthest = [0] * (2 * offset + 1)
+    # The furthest x of the diagonals -d to d, for every d
+    trace = []
+
     for d in range(0, lmax + rmax + 1):
         for k in range(-d, d + 1, 2):
-            if k == -d or (k != d and furthest[k - 1][0] < furthest[k + 1][0]):
+            i = k + offset
+            if k == -d or (k != d and furthest[i - 1] < furthest[i + 1]):
                 # Go down
-                old_x, history = furthest[k + 1]
-                x = old_x
+                x = furthest[i + 1]
             else:
                 # Go left
-                old_x, history = furthest[k - 1]
-                x = old_x + 1
+                x = furthest[i - 1] + 1
 
-            # Copy the history
-            history = history[:]
             y = x - k
 
             while x < lmax and y < rmax and eqfn(left[x], right[y]):
                 # We found a match
-                history.append((x + start, y + start))
                 x += 1
                 y += 1
 
@@ -145,20 +173,36 @@ def longest_common_subsequence(left_sequence, right_sequence, eqfn=eq):
                 # This is the best match
                 return (
                     [(e, e) for e in range(start)]
-                    + history
+                    + [
+                        (x + start, y + start)
+                        for x, y in _walk_back_snakes(trace, d, k, x)
+                    ]
                     + list(zip(range(lend, lslen), range(rend, rslen)))
                 )
             else:
-                furthest[k] = (x, history)
+                furthest[i] = x
+        trace.append(furthest[offset - d : offset + d + 1 : 2])
 
 
 WHITESPACE = re.compile("\\s+", flags=re.MULTILINE)
 
 
-def cleanup_whitespace(text):
+# Short texts, like attribute values or small text nodes, often come back
+# identical from both trees; longer ones are not worth keeping around.
+_CACHED_WHITESPACE_LENGTH = 200
+
+
+@lru_cache(maxsize=4096)
+def _cached_cleanup_whitespace(text):
     return WHITESPACE.sub(" ", text)
 
 
+def cleanup_whitespace(text):
+    if len(text) > _CACHED_WHITESPACE_LENGTH:
+        return WHITESPACE.sub(" ", text)
+    return _cached_cleanup_whitespace(text)
+
+
 def getpath(element, tree=None):
     if tree is None:
         tree = element.getroottree()
@@ -1,6 +1,10 @@
 import unittest
 
+from functools import lru_cache
+from itertools import chain
 from lxml import etree
+from textwrap import dedent
+from unittest import mock
 from markdowndiff import utils
 from markdowndiff.diff import Differ
 from markdowndiff.actions import (
@@ -18,11 +22,25 @@ from markdowndiff.actions import (
 from .testing import compare_elements
 
 
-def dedent(string):
-    """Remove the maximum common indent of the lines making up the string."""
-    lines = string.splitlines()
-    indent = min(len(line) - len(line.lstrip()) for line in lines if line)
-    return "\n".join(line[indent:] if line else line for line in lines)
+# Parsers by remove_blank_text, made once for all the fixtures
+PARSERS = {
+    False: etree.XMLParser(),
+    True: etree.XMLParser(remove_blank_text=True),
+}
+
+
+@lru_cache(maxsize=None)
+def parse_fixture(xml, remove_blank_text=False):
+    # Differ.set_trees() copies the left tree, and diffing never modifies the
+    # right one, so tests can share the parsed trees.
+    return etree.fromstring(xml, PARSERS[remove_blank_text])
+
+
+def match_paths(differ, matches):
+    # Wrap each tree once, rather than for every path
+    lpath = differ.left.getroottree().getpath
+    rpath = differ.right.getroottree().getpath
+    return [(lpath(lnode), rpath(rnode)) for lnode, rnode in matches]
 
 
 class APITests(unittest.TestCase):
@@ -56,16 +74,12 @@ class APITests(unittest.TestCase):
         # This is the way:
         res1 = self.differ.match(self.lefttree, self.righttree)
         print(res1)
-        lpath = self.differ.left.getroottree().getpath
-        rpath = self.differ.right.getroottree().getpath
-        res1x = [(lpath(x[0]), rpath(x[1])) for x in res1]
+        res1x = match_paths(self.differ, res1)
 
         # Or, you can use set_trees:
         self.differ.set_trees(self.lefttree, self.righttree)
         res2 = self.differ.match()
-        lpath = self.differ.left.getroottree().getpath
-        rpath = self.differ.right.getroottree().getpath
-        res2x = [(lpath(x[0]), rpath(x[1])) for x in res2]
+        res2x = match_paths(self.differ, res2)
 
         # The match sequences should be the same, of course:
         self.assertEqual(res1x, res2x)
@@ -76,6 +90,19 @@ class APITests(unittest.TestCase):
         # new sequences, we'll get a cached result:
         self.assertIs(self.differ.match(), res2)
 
+    def test_match_after_diff(self):
+        differ = Differ()
+        left = etree.fromstring("<document><p>Text</p></document>")
+        right = etree.fromstring("<document><p>Text</p><p>New</p></document>")
+        matches = differ.match(left, right)
+        self.assertEqual(len(matches), 2)
+        list(differ.diff())
+        # The nodes inserted by diff() are matched to their right nodes too
+        self.assertIs(differ.match(), matches)
+        self.assertEqual(
+            match_paths(differ, matches)[-1], ("/document/p[2]", "/document/p[2]")
+        )
+
     def test_diff(self):
         # Passing in just one parameter causes an error:
         with self.assertRaises(TypeError):
@@ -89,9 +116,8 @@ class APITests(unittest.TestCase):
         res1 = list(self.differ.diff(self.lefttree, self.righttree))
 
         # Or, you can use set_trees() or match()
-        # We need to reparse self.lefttree, since after the diffing they
-        # are equal.
-        self.lefttree = etree.fromstring(self.left)
+        # The differ works on a copy of the left tree, so self.lefttree is
+        # still pristine and needs no reparsing.
         self.differ.set_trees(self.lefttree, self.righttree)
         res2 = list(self.differ.diff())
 
@@ -130,11 +156,33 @@ class NodeRatioTests(unittest.TestCase):
             utils.post_order_traverse(differ.right),
         ):
             self.assertEqual(differ.leaf_ratio(left, right)[1], 1.0)
-            if left.getchildren():
+            if len(left):
                 self.assertEqual(differ.child_ratio(left, right)[1], 1.0)
             else:
                 self.assertIsNone(differ.child_ratio(left, right)[1])
 
+    def test_full_vocabulary(self):
+        left = etree.fromstring("<para>one two three four five</para>")
+        right = etree.fromstring("<para>one two six four seven</para>")
+        expected = Differ().leaf_ratio(left, right)
+
+        # Once the shared vocabulary is full, the tokens are only mapped for
+        # the pair being compared, with the same result.
+        with mock.patch("markdowndiff.diff._VOCABULARY_SIZE", 3):
+            differ = Differ()
+            self.assertEqual(differ.leaf_ratio(left, right), expected)
+            self.assertEqual(len(differ._vocabulary), 3)
+
+    def test_node_ratio_below_f(self):
+        differ = Differ(F=0.9)
+        left = etree.fromstring("<p>First paragraph here</p>")
+        right = etree.fromstring("<p>paragraph First different</p>")
+        # The tokens are shared enough to get a high bound, but the exact
+        # ratio is still returned, even though both are below F.
+        self.assertAlmostEqual(differ.leaf_ratio_bound(left, right)[1], 2 / 3)
+        self.assertEqual(differ.node_ratio(left, right), 0.0)
+        self.assertLess(differ._node_ratio_if_reachable(left, right), differ.F)
+
     def test_compare_different_leafs(self):
         left = """<document>
     <story firstPageTemplate="FirstPage">
@@ -170,21 +218,24 @@ class NodeRatioTests(unittest.TestCase):
         righttree = etree.fromstring(right)
         differ = Differ()
 
+        lparas = lefttree.findall("story/section/para")
+        rparas = righttree.findall("story/section/para")
+
         # Make some choice comparisons here
         # These node are exactly the same
-        left = lefttree.xpath("/document/story/section[3]/para")[0]
-        right = righttree.xpath("/document/story/section[3]/para")[0]
+        left = lparas[2]
+        right = rparas[2]
 
         self.assertEqual(differ.leaf_ratio(left, right)[1], 1.0)
 
         # These nodes have slightly different text, but no children
-        left = lefttree.xpath("/document/story/section[2]/para")[0]
-        right = righttree.xpath("/document/story/section[2]/para")[0]
+        left = lparas[1]
+        right = rparas[1]
         self.assertEqual(differ.leaf_ratio(left, right)[1], 0.5)
 
         # These nodes should not be very similar
-        left = lefttree.xpath("/document/story/section[1]/para")[0]
-        right = righttree.xpath("/document/story/section[1]/para")[0]
+        left = lparas[0]
+        right = rparas[0]
         self.assertEqual(differ.leaf_ratio(left, right)[1], 0)
 
     def test_compare_different_nodes(self):
@@ -223,23 +274,25 @@ class NodeRatioTests(unittest.TestCase):
         differ = Differ()
         differ.set_trees(etree.fromstring(left), etree.fromstring(right))
         differ.match()
+        lsections = differ.left.findall("story/section")
+        rsections = differ.right.findall("story/section")
 
         # Make some choice comparisons here.
-        left = differ.left.xpath("/document/story/section[1]")[0]
-        right = differ.right.xpath("/document/story/section[1]")[0]
+        left = lsections[0]
+        right = rsections[0]
 
         # Only one of two matches, take weight into account:
         self.assertEqual(differ.child_ratio(left, right)[1], 0.6530612244897959)
 
-        left = differ.left.xpath("/document/story/section[2]")[0]
-        right = differ.right.xpath("/document/story/section[2]")[0]
+        left = lsections[1]
+        right = rsections[1]
 
         # Only one of two matches:
         self.assertEqual(differ.child_ratio(left, right)[1], 0.6530612244897959)
 
         # These nodes should not be very similar
-        left = differ.left.xpath("/document/story/section[3]")[0]
-        right = differ.right.xpath("/document/story/section[3]")[0]
+        left = lsections[2]
+        right = rsections[2]
         self.assertEqual(differ.child_ratio(left, right)[1], 1.0)
 
     def test_compare_with_xmlid(self):
@@ -278,11 +331,13 @@ class NodeRatioTests(unittest.TestCase):
         differ = Differ(uniqueattrs=["id"])
         differ.set_trees(etree.fromstring(left), etree.fromstring(right))
         differ.match()
+        lsections = differ.left.findall("story/section")
+        rsections = differ.right.findall("story/section")
 
         # Make some choice comparisons here.
 
-        left = differ.left.xpath("/document/story/section[1]")[0]
-        right = differ.right.xpath("/document/story/section[1]")[0]
+        left = lsections[0]
+        right = rsections[0]
 
         # No text and same tag
         self.assertEqual(differ.leaf_ratio(left, right)[1], 1.0)
@@ -292,8 +347,8 @@ class NodeRatioTests(unittest.TestCase):
         self.assertEqual(differ.node_ratio(left, right), 0)
 
         # Here's the ones with the same id:
-        left = differ.left.xpath("/document/story/section[1]")[0]
-        right = differ.right.xpath("/document/story/section[2]")[0]
+        left = lsections[0]
+        right = rsections[1]
 
         # Only one out of two children in common
         self.assertEqual(differ.child_ratio(left, right)[1], 0.5783132530120482)
@@ -302,8 +357,8 @@ class NodeRatioTests(unittest.TestCase):
 
         # The last ones are completely similar, but only one
         # has an xml:id, so they do not match.
-        left = differ.left.xpath("/document/story/section[3]")[0]
-        right = differ.right.xpath("/document/story/section[3]")[0]
+        left = lsections[2]
+        right = rsections[2]
         self.assertEqual(differ.leaf_ratio(left, right)[1], 1)  # no text and same tag
         self.assertEqual(differ.child_ratio(left, right)[1], 1.0)
         self.assertEqual(differ.node_ratio(left, right), 0)
@@ -361,11 +416,13 @@ class NodeRatioTests(unittest.TestCase):
         )
         differ.set_trees(etree.fromstring(left), etree.fromstring(right))
         differ.match()
+        lsections = differ.left.findall("story/section")
+        rsections = differ.right.findall("story/section")
 
         # Make some choice comparisons here.
 
-        left = differ.left.xpath("/document/story/section[1]")[0]
-        right = differ.right.xpath("/document/story/section[1]")[0]
+        left = lsections[0]
+        right = rsections[0]
 
         # Both have no text
         self.assertEqual(differ.leaf_ratio(left, right)[1], 1)
@@ -375,8 +432,8 @@ class NodeRatioTests(unittest.TestCase):
         self.assertEqual(differ.node_ratio(left, right), 0)
 
         # Here's the ones with the same tag and name attribute:
-        left = differ.left.xpath("/document/story/section[1]")[0]
-        right = differ.right.xpath("/document/story/section[2]")[0]
+        left = lsections[0]
+        right = rsections[1]
 
         # One child in common with the post processing
         self.assertAlmostEqual(differ.child_ratio(left, right)[1], 0.5783132530120482)
@@ -385,16 +442,16 @@ class NodeRatioTests(unittest.TestCase):
 
         # The last ones are completely similar, but only one
         # has a name, so they do not match.
-        left = differ.left.xpath("/document/story/section[3]")[0]
-        right = differ.right.xpath("/document/story/section[3]")[0]
+        left = lsections[2]
+        right = rsections[2]
         self.assertEqual(differ.leaf_ratio(left, right)[1], 1.0)
         self.assertEqual(differ.child_ratio(left, right)[1], 1.0)
         self.assertEqual(differ.node_ratio(left, right), 0)
 
         # Now these are structurally similar, have the same name, but
         # one of them is not a section, so leaf_ratio should be 0
-        left = differ.left.xpath("/document/story/section[1]")[0]
-        right = differ.right.xpath("/document/story/subsection[1]")[0]
+        left = lsections[0]
+        right = differ.right.find("story/subsection")
         self.assertEqual(differ.leaf_ratio(left, right)[1], 0.0)
         # The post processing remove the matching childs
         self.assertEqual(differ.child_ratio(left, right)[1], 0.0)
@@ -416,27 +473,56 @@ class NodeRatioTests(unittest.TestCase):
         differ.match()
 
         # Make some choice comparisons here.
-        left = differ.left.xpath(
-            "/document/foo:para[1]", namespaces={"foo": "someuri"}
-        )[0]
-        right = differ.right.xpath(
-            "/document/foo:para[1]", namespaces={"foo": "otheruri"}
-        )[0]
+        left = differ.left.find("{someuri}para")
+        right = differ.right.find("{otheruri}para")
 
         # These have different namespaces, but should still match
         self.assertEqual(differ.leaf_ratio(left, right)[1], 1.0)
 
+    def test_leaf_ratio_bound(self):
+        left = """<document>
+    <para>First paragraph</para>
+    <para>This doesn't match at all</para>
+    <para></para>
+</document>
+"""
+
+        right = """<document>
+    <para>Another paragraph</para>
+    <para>Completely different from before</para>
+    <para>paragraph First</para>
+</document>
+"""
+        differ = Differ()
+        lefttree = etree.fromstring(left)
+        righttree = etree.fromstring(right)
+
+        # The bound is never lower than the actual leaf ratio
+        for lnode in lefttree:
+            for rnode in righttree:
+                weight, ratio = differ.leaf_ratio(lnode, rnode)
+                self.assertEqual(differ.leaf_ratio_bound(lnode, rnode)[0], weight)
+                self.assertGreaterEqual(
+                    differ.leaf_ratio_bound(lnode, rnode)[1], ratio
+                )
+
+        # Same tokens in a different order: the bound can't tell them apart
+        self.assertEqual(differ.leaf_ratio_bound(lefttree[0], righttree[2])[1], 1.0)
+        self.assertEqual(differ.leaf_ratio(lefttree[0], righttree[2])[1], 0.0)
+
+        # Identical texts are a total match
+        self.assertEqual(differ.leaf_ratio(lefttree[1], lefttree[1]), (25, 1.0))
+
 
 class MatchTests(unittest.TestCase):
+    # set_trees() clears all the state, so one differ serves every test
+    differ = Differ(uniqueattrs=["id"])
+
     def _match(self, left, right):
-        left_tree = etree.fromstring(left)
-        right_tree = etree.fromstring(right)
-        differ = Differ(uniqueattrs=["id"])
-        differ.set_trees(left_tree, right_tree)
-        matches = differ.match()
-        lpath = differ.left.getroottree().getpath
-        rpath = differ.right.getroottree().getpath
-        return [(lpath(item[0]), rpath(item[1])) for item in matches]
+        left_tree = parse_fixture(left)
+        right_tree = parse_fixture(right)
+        self.differ.set_trees(left_tree, right_tree)
+        return match_paths(self.differ, self.differ.match())
 
     def test_same_tree(self):
         xml = """<document>
@@ -739,15 +825,14 @@ class MatchTests(unittest.TestCase):
 
 
 class FastMatchTests(unittest.TestCase):
+    differs = {False: Differ(), True: Differ(fast_match=True)}
+
     def _match(self, left, right, fast_match):
-        left_tree = etree.fromstring(left)
-        right_tree = etree.fromstring(right)
-        differ = Differ(fast_match=fast_match)
+        left_tree = parse_fixture(left)
+        right_tree = parse_fixture(right)
+        differ = self.differs[fast_match]
         differ.set_trees(left_tree, right_tree)
-        matches = differ.match()
-        lpath = differ.left.getroottree().getpath
-        rpath = differ.right.getroottree().getpath
-        return [(lpath(item[0]), rpath(item[1])) for item in matches]
+        return match_paths(differ, differ.match())
 
     def test_move_paragraph(self):
         left = """<document>
@@ -825,18 +910,25 @@ class FastMatchTests(unittest.TestCase):
 class UpdateNodeTests(unittest.TestCase):
     """Testing only the update phase of the diffing"""
 
+    differ = Differ()
+
     def _match(self, left, right):
-        left_tree = etree.fromstring(left)
-        right_tree = etree.fromstring(right)
-        differ = Differ()
+        left_tree = parse_fixture(left)
+        right_tree = parse_fixture(right)
+        differ = self.differ
         differ.set_trees(left_tree, right_tree)
         matches = differ.match()
-        steps = []
-        for left, right in matches:
-            steps.extend(differ.update_node_attr(left, right))
-            steps.extend(differ.update_node_text(left, right))
-
-        return steps
+        # The generators are consumed in order, so each update is applied
+        # before the next one is computed, as in Differ.diff()
+        return list(
+            chain.from_iterable(
+                chain(
+                    differ.update_node_attr(lnode, rnode),
+                    differ.update_node_text(lnode, rnode),
+                )
+                for lnode, rnode in matches
+            )
+        )
 
     def test_same_tree(self):
         xml = """<document>
@@ -882,16 +974,19 @@ class UpdateNodeTests(unittest.TestCase):
 class AlignChildrenTests(unittest.TestCase):
     """Testing only the align phase of the diffing"""
 
+    differ = Differ()
+
     def _align(self, left, right):
-        left_tree = etree.fromstring(left)
-        right_tree = etree.fromstring(right)
-        differ = Differ()
+        left_tree = parse_fixture(left)
+        right_tree = parse_fixture(right)
+        differ = self.differ
         differ.set_trees(left_tree, right_tree)
         matches = differ.match()
-        steps = []
-        for left, right in matches:
-            steps.extend(differ.align_children(left, right))
-        return steps
+        return list(
+            chain.from_iterable(
+                differ.align_children(lnode, rnode) for lnode, rnode in matches
+            )
+        )
 
     def test_same_tree(self):
         xml = """<document>
@@ -975,11 +1070,12 @@ class AlignChildrenTests(unittest.TestCase):
 class DiffTests(unittest.TestCase):
     """Testing only the align phase of the diffing"""
 
+    differ = Differ()
+
     def _diff(self, left, right):
-        parser = etree.XMLParser(remove_blank_text=True)
-        left_tree = etree.fromstring(left, parser)
-        right_tree = etree.fromstring(right, parser)
-        differ = Differ()
+        left_tree = parse_fixture(left, remove_blank_text=True)
+        right_tree = parse_fixture(right, remove_blank_text=True)
+        differ = self.differ
         differ.set_trees(left_tree, right_tree)
         editscript = list(differ.diff())
         compare_elements(differ.left, differ.right)
@@ -1174,9 +1270,8 @@ class DiffTests(unittest.TestCase):
         left = '<a><b foo="bar" skip="boom">text</b></a>'
         right = '<a><b foo="bar" skip="different">text</b></a>'
 
-        parser = etree.XMLParser(remove_blank_text=True)
-        left_tree = etree.fromstring(left, parser)
-        right_tree = etree.fromstring(right, parser)
+        left_tree = parse_fixture(left, remove_blank_text=True)
+        right_tree = parse_fixture(right, remove_blank_text=True)
         differ = IgnoringDiffer()
         differ.set_trees(left_tree, right_tree)
         editscript = list(differ.diff())
@@ -12,10 +12,19 @@ END = "</node></document>"
 DIFF_NS = "http://namespaces.shoobx.com/diff"
 DIFF_PREFIX = "diff"
 
+# The format tests have no use for the xml:id index, comments or PIs
+PARSER = etree.XMLParser(collect_ids=False, remove_comments=True, remove_pis=True)
+
+# The file based tests remove blank text when the formatter normalizes tags
+FILE_PARSERS = {
+    False: etree.XMLParser(),
+    True: etree.XMLParser(remove_blank_text=True),
+}
+
 class XMLFormatTests(unittest.TestCase):
     def _format_test(self, left, action, expected):
         formatter = formatting.XMLFormatter(pretty_print=False)
-        result = formatter.format([action], etree.fromstring(left))
+        result = formatter.format([action], etree.fromstring(left, PARSER))
         self.assertEqual(result, expected)
 
     def test_incorrect_xpaths(self):
@@ -30,6 +39,37 @@ class XMLFormatTests(unittest.TestCase):
             action = actions.DeleteAttrib("/document/ummagumma", "a")
             self._format_test(left, action, expected)
 
+    def test_ambiguous_xpath(self):
+        # A step without an index must match only one node, even when the
+        # rest of the path then leads to a single element.
+        left = "<document><node><p>a</p></node><node><q>b</q></node></document>"
+        action = actions.DeleteNode("/document/node/p[1]")
+        with self.assertRaises(ValueError):
+            self._format_test(left, action, "")
+
+    def test_comment_and_pi(self):
+        # Comments and processing instructions are nodes of the trees too
+        left = "<body><p>a b</p><!--c--><?pi x?><p>x y</p></body>"
+        right = "<body><p>a b</p><!--c--><?pi x?><p>x y</p><p>z</p></body>"
+        result = main.diff_trees(etree.fromstring(left), etree.fromstring(right))
+        self.assertEqual(
+            result,
+            [
+                actions.InsertNode("/body[1]", "p", 4),
+                actions.UpdateTextIn("/body/p[3]", "z"),
+            ],
+        )
+
+        formatter = formatting.XMLFormatter(pretty_print=False)
+        result = main.diff_trees(
+            etree.fromstring(left), etree.fromstring(right), formatter=formatter
+        )
+        self.assertEqual(
+            result,
+            '<body xmlns:diff="http://namespaces.shoobx.com/diff"><p>a b</p>'
+            '<?pi x?><p>x y</p><p diff:insert="">z</p></body>',
+        )
+
     def test_del_attr(self):
         left = '<document><node a="v">Text</node></document>'
         action = actions.DeleteAttrib("/document/node", "a")
@@ -143,7 +183,7 @@ class FormatterFileTests(unittest.TestCase):
 
     def process(self, left, right):
         normalize = bool(getattr(self.formatter, "normalize", 1) & formatting.WS_TAGS)
-        parser = etree.XMLParser(remove_blank_text=normalize)
+        parser = FILE_PARSERS[normalize]
         left_tree = etree.parse(left, parser)
         right_tree = etree.parse(right, parser)
         return main.diff_trees(
@@ -198,7 +238,7 @@ class HTMLFormatterTests(unittest.TestCase):
 
         etree.register_namespace(DIFF_PREFIX, DIFF_NS)
         etree.cleanup_namespaces(tree, top_nsmap={DIFF_PREFIX: DIFF_NS})
-        return etree.tounicode(tree)
+        return etree.tostring(tree, encoding="unicode")
 
     def test_diff_process(self):
         text = """<p>another <b> text in a lot of bold</b> and yet some more <b>bold</b></p>"""
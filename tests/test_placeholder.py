@@ -23,35 +23,87 @@ class PlaceholderMakerTests(unittest.TestCase):
         ph = replacer.get_placeholder(etree.Element("tag"), replacer.T_CLOSE, ph)
         self.assertEqual(ph, "\ue006")
 
-    def test_do_element(self):
-        replacer = placeholder.PlaceholderMaker(["p"], ["b"])
-
-        # Formatting tags get replaced, and the content remains
-        text = "<p>This is a tag with <b>formatted</b> text.</p>"
-        element = etree.fromstring(text)
-        replacer.do_element(element)
+    def test_get_modified_ph(self):
+        replacer = placeholder.PlaceholderMaker()
+        open_ph, close_ph = replacer.get_both_placeholders(etree.Element("b"))
+        ph = replacer.get_modified_ph(open_ph, "insert-formatting")
+        self.assertEqual(ph, "\ue008")
+        entry = replacer.placeholder2tag[ph]
+        self.assertEqual(entry.ttype, replacer.T_OPEN)
+        self.assertEqual(entry.close_ph, "\ue007")
+        self.assertEqual(entry.element.get("{%s}insert-formatting" % DIFF_NS), "")
+        # The same modification gives the same placeholder:
+        self.assertEqual(replacer.get_modified_ph(open_ph, "insert-formatting"), ph)
+        ph = replacer.get_modified_ph(close_ph, "insert-formatting")
+        self.assertEqual(ph, "\ue007")
+
+    def test_split_string(self):
+        replacer = placeholder.PlaceholderMaker()
+        open_ph, close_ph = replacer.get_both_placeholders(etree.Element("b"))
+        self.assertEqual(
+            replacer.split_string("a" + open_ph + "b" + close_ph),
+            ["a", open_ph, "b", close_ph, ""],
+        )
+        # New placeholders are split as well
+        single_ph = replacer.get_placeholder(
+            etree.Element("br"), replacer.T_SINGLE, None
+        )
+        self.assertEqual(
+            replacer.split_string("a" + single_ph + "b"), ["a", single_ph, "b"]
+        )
 
+    def test_undo_string(self):
+        replacer = placeholder.PlaceholderMaker()
+        open_ph, close_ph = replacer.get_both_placeholders(etree.Element("b"))
+        head, elements = replacer.undo_string("a" + open_ph + "b" + close_ph + "c")
+        self.assertEqual(head, "a")
         self.assertEqual(
-            etree.tounicode(element),
-            "<p>This is a tag with \ue006formatted\ue005 text.</p>",
+            [etree.tostring(e, encoding="unicode") for e in elements], ["<b>b</b>c"]
         )
+        # The texts around a lone close placeholder are both kept
+        head, elements = replacer.undo_string("a" + close_ph + "b" + open_ph + close_ph)
+        self.assertEqual(head, "ab")
+        head, elements = replacer.undo_string(open_ph + close_ph + "c" + close_ph + "d")
+        self.assertIsNone(head)
+        self.assertEqual(elements[0].tail, "cd")
+
+    # The input, and the results of do_element() and undo_element() on it,
+    # all with the same replacer
+    DO_ELEMENT_CASES = (
+        # Formatting tags get replaced, and the content remains
+        (
+            "<p>This is a tag with <b>formatted</b> text.</p>",
+            "<p>This is a tag with \ue006formatted\ue005 text.</p>",
+            "<p>This is a tag with <b>formatted</b> text.</p>",
+        ),
+        # Non formatting tags do not get replaced
+        (
+            "<p>This is a tag with <foo>formatted</foo> text.</p>",
+            "<p>This is a tag with <foo>formatted</foo> text.</p>",
+            "<p>This is a tag with <foo>formatted</foo> text.</p>",
+        ),
+        # Single formatting tags still get two placeholders, and come back
+        # with an empty text.
+        (
+            "<p>This is a <b/> with <foo/> text.</p>",
+            "<p>This is a \ue008\ue007 with <foo/> text.</p>",
+            "<p>This is a <b></b> with <foo/> text.</p>",
+        ),
+    )
 
-        replacer.undo_element(element)
-        self.assertEqual(etree.tounicode(element), text)
+    def test_do_element(self):
+        replacer = placeholder.PlaceholderMaker(["p"], ["b"])
 
-        # Non formatting tags do not get replaced
-        text = "<p>This is a tag with <foo>formatted</foo> text.</p>"
-        element = etree.fromstring(text)
-        replacer.do_element(element)
-        result = etree.tounicode(element)
-        self.assertEqual(result, "<p>This is a tag with <foo>formatted</foo> text.</p>")
+        for text, done, undone in self.DO_ELEMENT_CASES:
+            with self.subTest(text=text):
+                element = etree.fromstring(text)
+                replacer.do_element(element)
+                result = etree.tostring(element, encoding="unicode")
+                self.assertEqual(result, done)
 
-        # Single formatting tags still get two placeholders.
-        text = "<p>This is a <b/> with <foo/> text.</p>"
-        element = etree.fromstring(text)
-        replacer.do_element(element)
-        result = etree.tounicode(element)
-        self.assertEqual(result, "<p>This is a \ue008\ue007 with <foo/> text.</p>")
+                replacer.undo_element(element)
+                result = etree.tostring(element, encoding="unicode")
+                self.assertEqual(result, undone)
 
     def test_do_undo_element(self):
         replacer = placeholder.PlaceholderMaker(["p"], ["b"])
@@ -64,7 +116,7 @@ class PlaceholderMakerTests(unittest.TestCase):
         self.assertEqual(element.text, "This ")
 
         replacer.undo_element(element)
-        result = etree.tounicode(element)
+        result = etree.tostring(element, encoding="unicode")
         self.assertEqual(result, text)
 
     def test_do_undo_element_double_format(self):
@@ -80,7 +132,7 @@ class PlaceholderMakerTests(unittest.TestCase):
         )
 
         replacer.undo_element(element)
-        result = etree.tounicode(element)
+        result = etree.tostring(element, encoding="unicode")
         self.assertEqual(result, text)
 
     def test_rml_bug(self):
@@ -115,7 +167,7 @@ class PlaceholderMakerTests(unittest.TestCase):
         replacer.placeholder2tag["\ue005"].element.attrib[delete_attrib] = ""
         tree = etree.fromstring(after_diff)
         replacer.undo_tree(tree)
-        result = etree.tounicode(tree)
+        result = etree.tostring(tree, encoding="unicode")
         expected = """<document xmlns:diff="http://namespaces.shoobx.com/diff">
                           <section>
                             <para>
@@ -154,7 +206,7 @@ class HTMLPlaceholderMakerTests(unittest.TestCase):
         )
 
         replacer.undo_element(element)
-        result = etree.tounicode(element)
+        result = etree.tostring(element, encoding="unicode")
         self.assertEqual(result, text)
 
     def test_complex_case(self):
@@ -184,9 +236,9 @@ class HTMLPlaceholderMakerTests(unittest.TestCase):
           </div>
         </body>"""
 
-        self.assertEqual(etree.tounicode(element), replaced_text)
+        self.assertEqual(etree.tostring(element, encoding="unicode"), replaced_text)
         replacer.undo_tree(element)
-        result = etree.tounicode(element)
+        result = etree.tostring(element, encoding="unicode")
         self.assertEqual(result, text)
 
     def test_dual_formatting(self):